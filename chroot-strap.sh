@@ -1,26 +1,11 @@
 #!/bin/bash
 
-LIB_PATHS="/usr/lib /lib"
+SCRIPT_DIR="$(dirname "$(realpath "$0")")"
 SEED_DEPENDENCY="/bin/bash"
 
-array=
+# elf-deps.py reads the dynamic sections directly and resolves sonames
+# through ld.so.cache, RPATH/RUNPATH and the default library paths,
+# printing each needed file once with dependencies first.
+array=($(python3 "$SCRIPT_DIR/elf-deps.py" $SEED_DEPENDENCY)) || exit 1
 
-search_deps()
-{
-	seed=$1
-	obj=`objdump -p $seed | grep NEEDED | rev | cut -d " " -f1 | rev`
-
-	for item in $obj; do
-		echo "Dep find $item"
-		# Find file
-		loc=`find $LIB_PATHS -name $item`
-		# Follow link if necessary
-		dep=`realpath $loc`
-		search_deps $dep
-	done
-	array+=($1)
-}
-
-search_deps /bin/bash
-
-echo ${array[@]} | tr " " "\n"
\ No newline at end of file
+echo ${array[@]} | tr " " "\n"
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import gzip
+import lzma
+import bz2
+import json
+import random
+import resource
+import platform
+import argparse
+import tempfile
+import subprocess
+import time
+from statistics import median
+
+from siblings import SCRIPT_DIR, load_script
+
+
+debdeps = load_script("deb-deps")
+debtopo = load_script("deb-topological")
+
+# Bump when stages or their units change, so --compare refuses reports
+# that do not measure the same thing
+REPORT_VERSION = 1
+
+SYLLABLES = ["gtk", "x", "lib", "perl", "py", "font", "ssl", "core", "util", "net", "gl", "kde",
+             "ruby", "tex", "doc", "sys", "db", "qt", "audio", "tool", "mesa", "boost", "cups"]
+SUFFIXES = ["", "", "", "", "-dev", "-common", "-data", "-bin", "-doc", "-dbg"]
+SECTIONS = ["libs", "utils", "devel", "admin", "net", "doc", "python", "perl", "x11", "fonts"]
+
+
+def synthetic_name(rng, n):
+    # Debian-like names of realistic length; the hex index keeps them unique
+    words = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3)))
+    return f"{words}{n:x}{rng.choice(SUFFIXES)}"
+
+
+def synthetic_version(rng):
+    version = f"{rng.randint(0, 20)}.{rng.randint(0, 30)}.{rng.randint(0, 9)}-{rng.randint(1, 9)}"
+    if rng.random() < 0.3:
+        version = f"{rng.randint(1, 3)}:{version}"
+    return version
+
+
+def open_for_write(filename):
+    # The suffix picks the encoding, so every format open_index reads can be generated
+    for ext, opener in ((".gz", gzip.open), (".xz", lzma.open), (".bz2", bz2.open)):
+        if filename.endswith(ext):
+            return opener(filename, "wt", encoding="utf-8")
+
+    return open(filename, "w", encoding="utf-8")
+
+
+def generate_archive(filename, packages=20000, fanout=4.0, provides=0.05, alternatives=0.1, cycles=20, seed=1):
+    """Write a synthetic Packages index of packages stanzas to filename.
+
+    Each package depends on about fanout earlier packages, drawn with a
+    strong bias towards the first ones so a few "libc6"s end up with most
+    of the reverse dependencies, and some dependencies are versioned in a
+    way the target satisfies. A provides fraction of the packages also
+    provide one of a pool of virtual names, which other packages then
+    depend on; an alternatives fraction of the relations get a second
+    | alternative. Every dependency points at an earlier package, so the
+    graph is acyclic until cycles back edges are added, each closing a
+    loop through a direct first-alternative dependency.
+
+    Returns the parameters used, for the benchmark report.
+    """
+    rng = random.Random(seed)
+    names = [synthetic_name(rng, n) for n in range(packages)]
+    versions = [synthetic_version(rng) for _ in range(packages)]
+    virtuals = [f"{rng.choice(SYLLABLES)}-virtual{n:x}" for n in range(max(1, int(packages * provides / 3)))]
+
+    provided = {}
+    provides_of = [None] * packages
+    for n in range(packages):
+        if rng.random() < provides:
+            virtual = rng.choice(virtuals)
+            provides_of[n] = virtual
+            provided.setdefault(virtual, []).append(n)
+    provided_names = list(provided)
+
+    def target(n):
+        return int(n * rng.random() ** 2.5)
+
+    depends = []
+    direct = []
+    for n in range(packages):
+        groups = []
+        firsts = []
+
+        count = min(n, int(rng.expovariate(1 / fanout))) if fanout else 0
+        for t in sorted({target(n) for _ in range(count)}):
+            # Versioned relations are always met by the target's version
+            relation = names[t]
+            roll = rng.random()
+            if roll < 0.2:
+                relation += f" (>= {versions[t]})"
+            elif roll < 0.25:
+                relation += f" (= {versions[t]})"
+            firsts.append(t)
+
+            if rng.random() < alternatives:
+                virtual = rng.choice(virtuals)
+                relation += f" | {virtual if virtual in provided and rng.random() < 0.5 else names[target(n)]}"
+
+            groups.append(relation)
+
+        # Only virtuals provided by earlier packages, to keep the graph acyclic
+        if provided_names and rng.random() < provides * 2:
+            virtual = rng.choice(provided_names)
+            if all(p < n for p in provided[virtual]):
+                groups.append(virtual)
+
+        depends.append(groups)
+        direct.append(firsts)
+
+    # A back edge from a first-alternative dependency to its
+    # dependent closes a two-package loop, like libc6 and libgcc1
+    with_direct = [n for n in range(packages) if direct[n]]
+    for _ in range(cycles if with_direct else 0):
+        n = rng.choice(with_direct)
+        depends[rng.choice(direct[n])].append(names[n])
+
+    with open_for_write(filename) as f:
+        for n in range(packages):
+            name = names[n]
+            size = int(rng.lognormvariate(10, 1.5))
+            lines = [
+                f"Package: {name}",
+                f"Architecture: {rng.choice(['amd64'] * 4 + ['all'])}",
+                f"Version: {versions[n]}",
+                f"Priority: {rng.choice(['optional'] * 9 + ['required'])}",
+                f"Section: {rng.choice(SECTIONS)}",
+                f"Maintainer: Synthetic Maintainers <maint{n % 97}@example.org>",
+                f"Installed-Size: {size * 3 // 1024 + 1}",
+            ]
+            if provides_of[n]:
+                lines.append(f"Provides: {provides_of[n]}")
+            if depends[n]:
+                key = "Pre-Depends" if rng.random() < 0.03 else "Depends"
+                lines.append(f"{key}: {', '.join(depends[n])}")
+            lines += [
+                f"Filename: pool/main/{name[0]}/{name}/{name}_{versions[n].split(':')[-1]}_amd64.deb",
+                f"Size: {size}",
+                f"SHA256: {rng.getrandbits(256):064x}",
+                f"Description: synthetic package {n}",
+                " Generated for benchmarking. The long description is there so stanza",
+                " sizes, and with them parse costs, resemble those of a real archive.",
+                "",
+            ]
+            f.write("\n".join(lines) + "\n")
+
+    return {
+        "packages": packages, "fanout": fanout, "provides": provides,
+        "alternatives": alternatives, "cycles": cycles, "seed": seed,
+    }
+
+
+def peak_rss_kib():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=SCRIPT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_pipeline(filename, resolver):
+    """Run every stage once on fresh records.
+
+    Returns {stage: (seconds, items, unit, peak_rss_kib)}.
+    """
+    stages = {}
+
+    def stage(name, unit, func, count):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        stages[name] = (elapsed, count(result), unit, peak_rss_kib())
+        return result
+
+    url = "file://synthetic"
+    records = stage("parse", "stanzas", lambda: list(debdeps.parse_package_gz(filename, url)), len)
+    index = stage("index", "records", lambda: debdeps.build_index(debdeps.merge_indices({url: {"index": records}}, {})),
+                  lambda _: len(records))
+
+    # Every name as a root is the full-archive closure, the worst case
+    roots = [debdeps.Dependency(name, "", "") for name in sorted(index)]
+    closure = stage("resolve", "edges", lambda: resolver(roots, index, strict=False),
+                    lambda closure: len(roots) + sum(len(p.alternatives) for p in closure))
+
+    dependency_map = stage("dependency_map", "edges", lambda: debdeps.closure_dependency_map(closure, index),
+                           lambda dependency_map: sum(len(deps) for deps in dependency_map.values()))
+    stage("sort", "edges", lambda: debtopo.TopologicalSort(dependency_map).sort(),
+          lambda _: stages["dependency_map"][1])
+
+    return stages
+
+
+def benchmark(filename, repeat=3, resolver="first"):
+    """Time each stage repeat times on filename, keeping the fastest run.
+
+    Every repeat parses the index again, so later stages always start from
+    cold records (lazy Depends parsing included) like a real run does.
+    peak_rss_kib is the process high-water mark once the stage finished:
+    it includes the data of earlier stages, so compare it stage by stage
+    across reports rather than between stages.
+    """
+    resolve = debdeps.resolve_alternatives if resolver == "alternatives" else debdeps.resolve
+    runs = [run_pipeline(filename, resolve) for _ in range(repeat)]
+
+    with debdeps.open_index(filename) as f:
+        raw_bytes = sum(len(chunk) for chunk in iter(lambda: f.read(1 << 20), b""))
+
+    stages = {}
+    for name in runs[0]:
+        times = [run[name][0] for run in runs]
+        _, items, unit, _ = runs[0][name]
+        stages[name] = {
+            "wall_s": min(times),
+            "median_s": median(times),
+            "runs_s": times,
+            "items": items,
+            "unit": unit,
+            "per_s": items / min(times) if min(times) else None,
+            "peak_rss_kib": max(run[name][3] for run in runs),
+        }
+
+    stages["parse"]["mib_per_s"] = raw_bytes / (1 << 20) / stages["parse"]["wall_s"]
+
+    return {
+        "file": filename,
+        "compressed_bytes": os.path.getsize(filename),
+        "raw_bytes": raw_bytes,
+        "stages": stages,
+        "total_wall_s": sum(s["wall_s"] for s in stages.values()),
+        "peak_rss_kib": peak_rss_kib(),
+    }
+
+
+def compare(report, base, threshold):
+    """Print the per-stage change against base and return the stages slower than threshold allows."""
+    regressions = []
+
+    for name, stage in report["stages"].items():
+        old = base["stages"].get(name)
+        if not old:
+            continue
+
+        ratio = stage["wall_s"] / old["wall_s"] if old["wall_s"] else float("inf")
+        rss = stage["peak_rss_kib"] / old["peak_rss_kib"] if old["peak_rss_kib"] else float("inf")
+        print(f"{name}: {old['wall_s']:.3f}s -> {stage['wall_s']:.3f}s ({ratio:.2f}x) "
+              f"rss {old['peak_rss_kib']} -> {stage['peak_rss_kib']} KiB ({rss:.2f}x)", file=sys.stderr)
+
+        if ratio > 1 + threshold:
+            regressions.append(name)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parsing, indexing, resolving and sorting a synthetic archive')
+    parser.add_argument("--archive", help="Benchmark this Packages file instead of generating one")
+    parser.add_argument("--generate", metavar="FILE", help="Only write a synthetic Packages file (.gz, .xz, .bz2 or plain)")
+    parser.add_argument("-n", "--packages", type=int, default=20000, help="Number of packages to generate")
+    parser.add_argument("--fanout", type=float, default=4.0, help="Mean number of dependencies per package")
+    parser.add_argument("--provides", type=float, default=0.05, help="Fraction of packages that provide a virtual package")
+    parser.add_argument("--alternatives", type=float, default=0.1, help="Fraction of dependencies with a | alternative")
+    parser.add_argument("--cycles", type=int, default=20, help="Number of dependency cycles to add")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed, the same seed gives the same archive")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of the whole pipeline, the fastest is reported")
+    parser.add_argument("--resolver", choices=["first", "alternatives"], default="first", help="Benchmark resolve or resolve_alternatives")
+    parser.add_argument("-o", "--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", metavar="REPORT", help="Compare against an earlier JSON report")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown fraction over --compare that fails the run")
+
+    args  = parser.parse_args()
+    vargs = vars(args)
+
+    params = {key: vargs[key] for key in ("packages", "fanout", "provides", "alternatives", "cycles", "seed")}
+
+    if vargs["generate"]:
+        generate_archive(vargs["generate"], **params)
+        return
+
+    with tempfile.TemporaryDirectory(prefix="deb-bench.") as tmp:
+        filename = vargs["archive"]
+        if not filename:
+            filename = os.path.join(tmp, "Packages.gz")
+            start = time.perf_counter()
+            generate_archive(filename, **params)
+            print(f"Generated {params['packages']} packages in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        else:
+            params = None
+
+        result = benchmark(filename, vargs["repeat"], vargs["resolver"])
+
+    report = {
+        "version": REPORT_VERSION,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "apt_pkg": debdeps.apt_pkg is not None,
+        "resolver": vargs["resolver"],
+        "repeat": vargs["repeat"],
+        "archive": params,
+        **result,
+    }
+    # A generated archive lives in a temporary directory, params identify it
+    report["file"] = vargs["archive"]
+
+    if vargs["output"]:
+        with open(vargs["output"], "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+
+    if vargs["compare"]:
+        with open(vargs["compare"], "r") as f:
+            base = json.load(f)
+
+        if base.get("version") != REPORT_VERSION or base.get("archive") != report["archive"] \
+                or base.get("resolver") != report["resolver"]:
+            print(f"{vargs['compare']} measured a different archive or resolver, not comparing", file=sys.stderr)
+            return 2
+
+        regressions = compare(report, base, vargs["threshold"])
+        if regressions:
+            print(f"Slower than {vargs['compare']} by more than {vargs['threshold']:.0%}: {' '.join(regressions)}", file=sys.stderr)
+            return 1
+
+    return
+
+
+if __name__ == '__main__':
+    sys.exit(main())
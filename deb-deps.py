@@ -1,17 +1,56 @@
 import sys
+from sys import intern
 import argparse
 import json
-import wget
 import uuid
 import os
 import gzip
+import zlib
+import lzma
+import bz2
+import io
+import shutil
+import tarfile
+import threading
+import contextlib
+import tempfile
+import urllib.error
+import urllib.request
+import urllib.parse
+import hashlib
+import pickle
 import re
+import time
+import logging
+import cProfile
+import pstats
 from operator import attrgetter
-from collections import defaultdict
-from itertools import chain
+from collections import Counter, defaultdict, namedtuple
+from itertools import chain, repeat
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import subprocess
+import multiprocessing
 import getpass
-import apt_pkg
+from functools import cmp_to_key, lru_cache
+
+from siblings import load_script
+
+try:
+    import apt_pkg
+    apt_pkg.init_system()
+except ImportError:
+    # Fall back to the pure-Python comparator below
+    apt_pkg = None
+
+try:
+    import zstandard
+except ImportError:
+    # Packages.zst is then simply never chosen
+    zstandard = None
+
+# Pickled indices name their classes by module. Make that "deb_deps" both
+# when this file runs as a script and when a sibling script loads it.
+sys.modules.setdefault("deb_deps", sys.modules[__name__])
 
 
 def callProcess(cmd, live_output=False, printcmd=False, curdir="/", valid_returncodes=[0,], root=False, inc_returncode=False):
@@ -58,172 +97,1502 @@ def callProcess(cmd, live_output=False, printcmd=False, curdir="/", valid_return
 		raise
 
 
-def parse_package_gz(filename, repo_url):
-    package_list = []
-    with gzip.open(filename, "rb") as f:
-        lines = f.read().decode()
+class Metrics(object):
+    """Timed spans and counters for one run, off by default.
+
+    span(name) times a stage (fetch, decompress, parse, index, resolve,
+    sort, ...) and accumulates its count and seconds; count(name, n) adds
+    to a counter. Both are only ever called once per stage or per file,
+    never per stanza or per record, and while disabled span() hands back
+    one shared no-op context manager, so the hot paths cost nothing.
+    select_candidate and satisfying count their calls only once enabled
+    is set, and version comparisons come from the version_compare cache
+    statistics.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = defaultdict(lambda: [0, 0.0])
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+        self._compare_baseline = None
+
+    def add(self, name, seconds, count=1):
+        with self._lock:
+            span = self.spans[name]
+            span[0] += count
+            span[1] += seconds
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += n
+
+    def span(self, name):
+        return self._span(name) if self.enabled else _NO_SPAN
+
+    @contextlib.contextmanager
+    def _span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.add(name, elapsed)
+            logging.debug(f"{name} took {elapsed:.3f}s")
+
+    def snapshot(self):
+        """Return the spans and counters so far as a JSON-ready dict."""
+        counters = dict(self.counters)
+
+        if self._compare_baseline is not None:
+            info = version_compare.cache_info()
+            counters["version_comparisons"] = info.hits + info.misses - sum(self._compare_baseline[:2])
+            counters["version_cache_hits"] = info.hits - self._compare_baseline.hits
+
+        with self._lock:
+            spans = {name: {"count": count, "seconds": round(seconds, 6)} for name, (count, seconds) in self.spans.items()}
+
+        return {"spans": spans, "counters": dict(sorted(counters.items()))}
+
+    def log(self, level=logging.INFO):
+        snapshot = self.snapshot()
+        for name, span in snapshot["spans"].items():
+            logging.log(level, f"span {name}: {span['seconds']:.3f}s over {span['count']}")
+        for name, value in snapshot["counters"].items():
+            logging.log(level, f"counter {name}: {value}")
+
+
+_NO_SPAN = contextlib.nullcontext()
+
+metrics = Metrics()
+
+
+class _TimedReader(io.RawIOBase):
+    # Put between an index stream and its line buffering while metrics are
+    # enabled, so decompression is timed apart from the parse around it.
+    # Reads come in 1 MiB chunks, which keeps the timing overhead negligible.
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def readable(self):
+        return True
 
-        packages = lines.split("\n\n")
-        
-        for p in packages:
-            package_desc = {}
-            items = p.split("\n")
+    def readinto(self, b):
+        start = time.perf_counter()
+        n = self._stream.readinto(b)
+        metrics.add("decompress", time.perf_counter() - start, 0)
+        metrics.count("index_bytes_read", n or 0)
+        return n
 
-            for i in items:
-                j = i.split(":", 1)
+    def close(self):
+        self._stream.close()
+        super().close()
 
-                key = j[0] if j[0] else None
-                val = j[1].lstrip() if len(j) > 1 else None
 
-                if not key or not val:
+def enable_metrics():
+    """Start collecting metrics in this process."""
+    if metrics.enabled:
+        return
+
+    metrics.enabled = True
+    metrics._compare_baseline = version_compare.cache_info()
+
+
+def iter_stanzas(f):
+    """Yield each RFC822 stanza of a binary stream as a dict, one at a time.
+
+    Lines are pulled through the stream's own buffering, so only the
+    stanza currently being built is held in memory. Continuation lines
+    (leading space or tab) are folded into the previous field with a
+    newline, as dpkg does for multi-line fields such as Description.
+    """
+    stanza = {}
+    key = None
+
+    for raw in f:
+        line = raw.decode("utf-8", "replace").rstrip("\r\n")
+
+        if not line.strip():
+            if stanza:
+                yield stanza
+                stanza = {}
+            key = None
+            continue
+
+        if line[0] in " \t":
+            if key is not None:
+                stanza[key] += "\n" + line[1:]
+            continue
+
+        key, _, val = line.partition(":")
+        stanza[key] = val.strip()
+
+    if stanza:
+        yield stanza
+
+
+# One parsed relation from a Depends/Pre-Depends field. Tuples are far
+# smaller than the {"key":..., "value": {...}} dicts they replace. arch is
+# the ":any", ":native" or ":<arch>" qualifier, empty when there is none.
+Dependency = namedtuple("Dependency", ["name", "version_test", "version", "arch"], defaults=("",), module="deb_deps")
+
+
+def parse_relation(sub):
+    """Parse one "name[:arch] [(op version)]" relation into a Dependency."""
+    if len(sub.split(" ")) == 1:
+        name, _, arch = sub.partition(":")
+        return Dependency(intern(name), "", "", intern(arch))
+
+    sub_pck, version_str = re.sub('[()]', '', sub).split(" ", 1)
+    name, _, arch = sub_pck.partition(":")
+
+    return Dependency(
+        intern(name),
+        intern(version_str.split(" ")[0]) if len(version_str.split(" ")) > 1 else "=",
+        intern(version_str.split(" ")[1] if len(version_str.split(" ")) > 1 else version_str),
+        intern(arch)
+    )
+
+
+def parse_relations(val):
+    """Parse a Depends style field into a tuple of alternative groups.
+
+    "a, b (>= 1) | c" gives ((a,), (b, c)), each member a Dependency.
+    """
+    return tuple(
+        tuple(parse_relation(alt.strip()) for alt in group.split("|") if alt.strip())
+        for group in val.split(",") if group.strip()
+    )
+
+
+def parse_depends(val):
+    # Only the first of each group of alternatives, as apt would try first
+    return tuple(group[0] for group in parse_relations(val))
+
+
+def parse_provides(val):
+    # Provides may carry versions ("foo (= 1.0)"), only the names are indexed
+    return tuple(intern(p.split(" ", 1)[0]) for p in re.sub(", ", ",", val).split(",") if p)
+
+
+class PackageRecord(object):
+    """Compact in-memory form of one Packages stanza.
+
+    Names, versions, architectures and repo URLs are interned so the copies
+    shared between index[url]["index"], package_list and build_index all
+    point at the same string objects. Depends and Pre-Depends are kept as
+    the raw concatenated string until ``depends`` (first alternatives only)
+    or ``alternatives`` (every group in full) is first read, and likewise
+    Conflicts and Breaks until ``conflicts``. ``key`` names the record within a closure: the package
+    name, qualified with the architecture for Multi-Arch: same packages
+    that build_index finds in more than one architecture.
+    """
+
+    __module__ = "deb_deps"
+
+    __slots__ = (
+        "name", "version", "arch", "provides", "filename", "sha256",
+        "installed_size", "repo_url", "_depends_raw", "_depends",
+        "_alternatives", "_conflicts_raw", "_conflicts", "pin", "multi_arch", "key"
+    )
+
+    def __init__(self, name, version, arch="", provides=(), filename="", sha256="",
+                 repo_url="", depends_raw="", installed_size=0, conflicts_raw="", pin=500,
+                 multi_arch=""):
+        self.name = intern(name)
+        self.version = intern(version)
+        self.arch = intern(arch)
+        self.multi_arch = intern(multi_arch)
+        self.key = self.name
+        self.provides = provides
+        self.filename = filename
+        self.sha256 = sha256
+        self.installed_size = installed_size
+        self.repo_url = intern(repo_url)
+        self._depends_raw = depends_raw
+        self._depends = None
+        self._alternatives = None
+        self._conflicts_raw = conflicts_raw
+        self._conflicts = None
+        self.pin = pin
+
+    def _parse_depends(self):
+        # Resolver threads can race here. The raw string is only cleared
+        # after _depends, which is set last, so a racing thread either
+        # parses the same string again or sees _depends already set.
+        raw = self._depends_raw
+        if self._depends is not None:
+            return
+
+        groups = parse_relations(raw) if raw else ()
+        # Only kept when some group really has alternatives
+        self._alternatives = groups if any(len(group) > 1 for group in groups) else None
+        self._depends = tuple(group[0] for group in groups)
+        self._depends_raw = ""
+
+    @property
+    def depends(self):
+        if self._depends is None:
+            self._parse_depends()
+
+        return self._depends
+
+    @property
+    def alternatives(self):
+        if self._depends is None:
+            self._parse_depends()
+
+        if self._alternatives is None:
+            return tuple((dep,) for dep in self._depends)
+        return self._alternatives
+
+    @property
+    def conflicts(self):
+        if self._conflicts is None:
+            raw = self._conflicts_raw
+            if self._conflicts is None:
+                self._conflicts = parse_depends(raw) if raw else ()
+                self._conflicts_raw = ""
+
+        return self._conflicts
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, val in zip(self.__slots__, state):
+            setattr(self, slot, val)
+
+    def __repr__(self):
+        return f"PackageRecord({self.name} {self.version} {self.arch})"
+
+
+def iter_raw_stanzas(f):
+    """Yield each stanza of a binary stream as its raw bytes, unparsed."""
+    chunk = []
+
+    for line in f:
+        if line.strip():
+            chunk.append(line)
+        elif chunk:
+            yield b"".join(chunk)
+            chunk = []
+
+    if chunk:
+        yield b"".join(chunk)
+
+
+def _open_zstd(filename):
+    reader = zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), read_across_frames=True)
+    return io.BufferedReader(reader, 1 << 20)
+
+
+# (suffix, magic bytes, opener) of every compressed Packages encoding we
+# can stream from
+INDEX_FORMATS = [
+    (".gz", b"\x1f\x8b", lambda filename: gzip.open(filename, "rb")),
+    (".xz", b"\xfd7zXZ\x00", lambda filename: lzma.open(filename, "rb")),
+    (".bz2", b"BZh", lambda filename: bz2.open(filename, "rb")),
+]
+if zstandard is not None:
+    INDEX_FORMATS.append((".zst", b"\x28\xb5\x2f\xfd", _open_zstd))
+
+# Suffix preference for the "fastest" policy, cheapest to decode first,
+# and for "smallest" when no Release gives the actual sizes
+FASTEST_FORMATS = ["", ".zst", ".gz", ".xz", ".bz2"]
+SMALLEST_FORMATS = [".xz", ".bz2", ".zst", ".gz", ""]
+
+
+def open_index(filename):
+    # Local indices are kept as fetched, in whichever format was chosen,
+    # or uncompressed when they are maintained through pdiffs. Tell them
+    # apart by magic bytes and decompress as the stanzas are read.
+    with open(filename, "rb") as f:
+        magic = f.read(6)
+
+    opener = next((opener for _, prefix, opener in INDEX_FORMATS if magic.startswith(prefix)), None)
+    stream = opener(filename) if opener else open(filename, "rb")
+
+    if metrics.enabled:
+        metrics.add("decompress", 0.0)
+        return io.BufferedReader(_TimedReader(stream), 1 << 20)
+
+    return stream
+
+
+def index_formats(rel_path, release, policy="smallest"):
+    """Return the Packages suffixes worth fetching for rel_path, best first.
+
+    With a Release only the listed encodings we can read are returned,
+    ordered by their listed size for the "smallest" policy or by decoding
+    cost for "fastest". Without one every readable encoding is returned
+    in a typical order for the policy, to be probed in turn.
+    """
+    readable = [""] + [ext for ext, _, _ in INDEX_FORMATS]
+    order = FASTEST_FORMATS if policy == "fastest" else SMALLEST_FORMATS
+    listed = [ext for ext in readable if f"{rel_path}/Packages{ext}" in release]
+
+    if not listed:
+        return sorted(readable, key=order.index)
+
+    if policy == "fastest":
+        return sorted(listed, key=order.index)
+
+    return sorted(listed, key=lambda ext: (release[f"{rel_path}/Packages{ext}"][1], order.index(ext)))
+
+
+def make_record(stanza, repo_url):
+    depends_raw = ", ".join(
+        " ".join(stanza[key].split()) for key in ("Pre-Depends", "Depends") if stanza.get(key)
+    )
+    conflicts_raw = ", ".join(
+        " ".join(stanza[key].split()) for key in ("Conflicts", "Breaks") if stanza.get(key)
+    )
+
+    return PackageRecord(
+        stanza["Package"],
+        stanza.get("Version", ""),
+        arch=stanza.get("Architecture", ""),
+        provides=parse_provides(stanza["Provides"]) if stanza.get("Provides") else (),
+        filename=stanza.get("Filename", ""),
+        sha256=stanza.get("SHA256", ""),
+        repo_url=repo_url,
+        depends_raw=depends_raw,
+        installed_size=int(stanza.get("Installed-Size") or 0),
+        conflicts_raw=conflicts_raw,
+        multi_arch=stanza.get("Multi-Arch", "")
+    )
+
+
+def parse_package_gz(filename, repo_url):
+    with open_index(filename) as f:
+        for stanza in iter_stanzas(f):
+            if not stanza.get("Package"):
+                continue
+
+            yield make_record(stanza, repo_url)
+
+
+def load_packages(filename, repo_url, state_dir=None):
+    """Parse one local index, re-using records from its previous parse.
+
+    The records of the last parse are kept in state_dir keyed by a hash of
+    each raw stanza. When the file changes (typically after a pdiff) every
+    stanza is still split out and hashed, but only stanzas whose bytes are
+    new get parsed into fresh PackageRecords.
+    """
+    if not state_dir:
+        with metrics.span("parse"):
+            records = list(parse_package_gz(filename, repo_url))
+        metrics.count("stanzas_parsed", len(records))
+        return records
+
+    key = hashlib.sha256(f"{repo_url} {os.path.basename(filename)}".encode())
+    state_file = os.path.join(state_dir, f"packages-{key.hexdigest()}.pickle")
+    digest = file_digest(filename)
+
+    old = {"version": INDEX_CACHE_VERSION, "digest": None, "stanzas": {}}
+    if os.path.exists(state_file):
+        try:
+            with open(state_file, "rb") as f:
+                loaded = pickle.load(f)
+            if loaded.get("version") == INDEX_CACHE_VERSION:
+                old = loaded
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable package state {state_file}: {e}")
+
+    if old["digest"] == digest:
+        metrics.count("stanza_cache_hits", len(old["stanzas"]))
+        return list(old["stanzas"].values())
+
+    stanzas = {}
+    parsed = 0
+    with metrics.span("parse"), open_index(filename) as f:
+        for raw in iter_raw_stanzas(f):
+            stanza_key = hashlib.blake2b(raw, digest_size=16).digest()
+            record = old["stanzas"].get(stanza_key)
+
+            if record is None:
+                stanza = next(iter_stanzas(raw.splitlines(True)), {})
+                if not stanza.get("Package"):
                     continue
+                record = make_record(stanza, repo_url)
+                parsed += 1
 
-                if key == "Pre-Depends" or key == "Depends":
-                    # print(val)
-                    # Concat PreDepends and Depends
-                    if len(val) > 0:
-                        if "Depends" not in package_desc.keys():
-                            package_desc["Depends"] = list()
-                            package_desc["DependsOrig"] = ""
-                        
-                        package_desc["DependsOrig"] += val
-
-                        val = re.sub(", ", ",", val).split(",")
-
-                        # package_desc["Depends"] = list()
-
-                        for sub in val:
-                            if len(sub.split(" ")) == 1:
-                                sub = sub.split(":")
-                                if len(sub) == 1:
-                                    sub = sub[0]
-                                else:
-                                    if sub[1] == "any":
-                                        sub = sub[0]
-                                    else:
-                                        raise Exception(f"Not able to handle this yet {sub}") # Colon splitting is architecture
-                                sub_pck_dict = {
-                                    "name": sub, 
-                                    "version": "",
-                                    "version_test": ""
-                                }
-                            else:
-                                sub_pck, version_str = re.sub('[()]', '', sub).split(" ", 1)
-
-                                sub_pck = sub_pck.split(":")
-                                if len(sub_pck) == 1:
-                                    sub_pck = sub_pck[0]
-                                else:
-                                    if sub_pck[1] == "any":
-                                        sub_pck = sub_pck[0]
-                                    else:
-                                        raise Exception(f"Not able to handle this yet {sub}")
-
-                                sub_pck_dict = {
-                                    "name": sub_pck,
-                                    "version": version_str.split(" ")[1] if len(version_str.split(" ")) > 1 else version_str,
-                                    "version_test": version_str.split(" ")[0] if len(version_str.split(" ")) > 1 else "=="
-                                }
-
-                            package_desc["Depends"].append({"key": sub_pck_dict["name"], "value": sub_pck_dict})
+            stanzas[stanza_key] = record
 
-                else:
-                    package_desc[key] = val
+    metrics.count("stanzas_parsed", parsed)
+    metrics.count("stanza_cache_hits", len(stanzas) - parsed)
 
-            if package_desc:
-                package_desc["repo_url"] = repo_url
-                package_list.append(package_desc)
+    write_pickle(state_file, {"version": INDEX_CACHE_VERSION, "digest": digest, "stanzas": stanzas})
 
-    return package_list
+    return list(stanzas.values())
 
 
-def get_repo_contents(user_config):
-    index = {}
-    package_list = []
+def fetch_url(url, filename, timeout=60, conditional=True):
+    """Download url to filename unless the server reports it unchanged.
+
+    ETag and Last-Modified from the previous download are kept in a
+    "<filename>.meta" sidecar and replayed as If-None-Match and
+    If-Modified-Since. With conditional=False the download is
+    unconditional and no sidecar is kept; a stale one is removed. The body is streamed to a unique temporary file in
+    the same directory and renamed into place, so concurrent fetches never
+    share a path and readers never see a partial file.
+
+    Returns True if filename was (re)written, False on 304 Not Modified.
+    """
+    meta_file = f"{filename}.meta"
+    headers = {}
+
+    if conditional and os.path.exists(filename) and os.path.exists(meta_file):
+        with open(meta_file, "r") as f:
+            meta = json.load(f)
+
+        if meta.get("url") == url:
+            if meta.get("ETag"):
+                headers["If-None-Match"] = meta["ETag"]
+            if meta.get("Last-Modified"):
+                headers["If-Modified-Since"] = meta["Last-Modified"]
+
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as resp:
+            atomic_write(filename, lambda f: shutil.copyfileobj(resp, f, 1 << 20))
+            metrics.count("downloads")
+            metrics.count("bytes_downloaded", os.path.getsize(filename))
+
+            if conditional:
+                meta = {"url": url, "ETag": resp.headers.get("ETag"), "Last-Modified": resp.headers.get("Last-Modified")}
+                atomic_write(meta_file, lambda f: f.write(json.dumps(meta).encode()))
+            elif os.path.exists(meta_file):
+                os.remove(meta_file)
+
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            metrics.count("not_modified")
+            return False
+
+        raise
+
+    return True
+
+
+def atomic_write(filename, writer):
+    fd, tmp = tempfile.mkstemp(prefix=f"{os.path.basename(filename)}.", suffix=".part",
+                               dir=os.path.dirname(filename) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            writer(f)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_pickle(filename, obj):
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    try:
+        atomic_write(filename, lambda f: pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception as e:
+        logging.warning(f"Failed to write {filename}: {e}")
+
+
+def parse_hash_list(val):
+    # " <hash> <size> <path>" lines of Release SHA256 and pdiff Index fields
+    entries = []
+    for line in val.splitlines():
+        parts = line.split()
+        if len(parts) == 3:
+            entries.append((parts[0], int(parts[1]), parts[2]))
+
+    return entries
+
+
+def parse_release(filename):
+    """Return the SHA256 entries of a Release/InRelease file as {path: (hash, size)}.
+
+    The PGP armour of InRelease is skipped, not verified.
+    """
+    with open(filename, "rb") as f:
+        lines = f.read().splitlines(True)
+
+    if lines and lines[0].startswith(b"-----BEGIN PGP SIGNED MESSAGE"):
+        # Drop the armour header block and everything from the signature on
+        start = lines.index(b"\n") + 1 if b"\n" in lines else 1
+        end = next((n for n, l in enumerate(lines) if l.startswith(b"-----BEGIN PGP SIGNATURE")), len(lines))
+        lines = lines[start:end]
+
+    release = next(iter_stanzas(lines), {})
+
+    return {path: (digest, size) for digest, size, path in parse_hash_list(release.get("SHA256", ""))}
+
+
+def fetch_release(repo, dist, download_dir, offline=False):
+    """Fetch and parse the InRelease (or Release) file of dists/dist, None if neither exists."""
+    url = f"{repo['repo_url']}/dists/{dist}"
+
+    for name in ("InRelease", "Release"):
+        filename = os.path.join(download_dir, f"{name}.{dist}")
+
+        try:
+            if not (offline and os.path.exists(filename)):
+                fetch_url(f"{url}/{name}", filename)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                continue
+            if not os.path.exists(filename):
+                raise
+        except (urllib.error.URLError, OSError):
+            if not os.path.exists(filename):
+                continue
+
+        return parse_release(filename)
+
+    return None
+
+
+def verify_file(filename, expected):
+    digest, size = expected
+
+    if os.path.getsize(filename) != size or file_digest(filename) != digest:
+        raise ValueError(f"{filename} does not match the SHA256/size listed in Release")
+
+
+def apply_ed_patch(lines, patch):
+    """Apply an ed script as produced by ``diff --ed`` (pdiff format) to lines in place.
+
+    Raises ValueError for a malformed script: an unknown command, a line
+    range outside lines or an unterminated text block. lines may already be
+    partly patched by then.
+    """
+    i = 0
+    while i < len(patch):
+        cmd = patch[i].rstrip(b"\n")
+        i += 1
+
+        if not cmd or cmd == b"w":
+            continue
+
+        m = re.match(rb"^(\d+)(?:,(\d+))?([acd])$", cmd)
+        if not m:
+            raise ValueError(f"Unsupported pdiff command {cmd!r}")
+
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else start
+        text = []
+
+        # a appends after line start (0 for the top), c and d need lines start..end
+        if end < start or end > len(lines) or (m.group(3) != b"a" and start < 1):
+            raise ValueError(f"pdiff command {cmd!r} out of range for {len(lines)} lines")
+
+        if m.group(3) in b"ac":
+            while i < len(patch) and patch[i].rstrip(b"\n") != b".":
+                text.append(patch[i])
+                i += 1
+            if i == len(patch):
+                raise ValueError(f"pdiff command {cmd!r} has no terminating '.'")
+            i += 1
+
+        if m.group(3) == b"a":
+            lines[start:start] = text
+        elif m.group(3) == b"c":
+            lines[start - 1:end] = text
+        else:
+            del lines[start - 1:end]
+
+
+def apply_pdiffs(url, filename, download_dir):
+    """Bring the uncompressed index filename up to date through Packages.diff.
+
+    Returns True if filename now matches SHA256-Current of the diff Index,
+    False if its current content is not part of the published history (the
+    caller then falls back to a full download). An Index with
+    "X-Patch-Precedence: merged", as Debian publishes, offers one patch
+    per history entry, T-<current>-F-<entry>, going straight to the current
+    index; otherwise every patch from the local entry on is applied in turn.
+    """
+    index_file = os.path.join(download_dir, f"{os.path.basename(filename)}.diff-Index")
+    fetch_url(f"{url}/Packages.diff/Index", index_file)
+
+    with open(index_file, "rb") as f:
+        diff_index = next(iter_stanzas(f), {})
+
+    current = diff_index.get("SHA256-Current", "").split()
+    history = parse_hash_list(diff_index.get("SHA256-History", ""))
+    patches = {name: (digest, size) for digest, size, name in parse_hash_list(diff_index.get("SHA256-Patches", ""))}
+    downloads = {name: (digest, size) for digest, size, name in parse_hash_list(diff_index.get("SHA256-Download", ""))}
+
+    digest = file_digest(filename)
+    if len(current) == 2 and digest == current[0]:
+        return True
+
+    names = [name for _, _, name in history]
+    start = next((n for n, (h, _, _) in enumerate(history) if h == digest), None)
+    if start is None or len(current) != 2:
+        return False
+
+    if diff_index.get("X-Patch-Precedence") == "merged":
+        published = list(patches) + [name[:-3] for name in downloads if name.endswith(".gz")]
+        chain = [name for name in published if name.startswith("T-") and name.endswith(f"-F-{names[start]}")][:1]
+        if not chain:
+            return False
+    else:
+        chain = names[start:]
+
+    with open(filename, "rb") as f:
+        lines = f.read().splitlines(True)
+
+    for name in chain:
+        patch_file = os.path.join(download_dir, f"{os.path.basename(filename)}.{name}.gz")
+        fetch_url(f"{url}/Packages.diff/{name}.gz", patch_file, conditional=False)
+
+        if f"{name}.gz" in downloads:
+            verify_file(patch_file, downloads[f"{name}.gz"])
+
+        try:
+            with gzip.open(patch_file, "rb") as f:
+                patch = f.read()
+        except (EOFError, zlib.error) as e:
+            raise ValueError(f"pdiff {name} is not valid gzip: {e}")
+        finally:
+            os.remove(patch_file)
+
+        if name in patches and hashlib.sha256(patch).hexdigest() != patches[name][0]:
+            raise ValueError(f"pdiff {name} does not match its SHA256")
+
+        apply_ed_patch(lines, patch.splitlines(True))
+
+    atomic_write(filename, lambda f: f.writelines(lines))
+    verify_file(filename, (current[0], int(current[1])))
+
+    return True
+
+
+def sync_index(url, local_template, rel_path, release, download_dir, offline=False, policy="smallest"):
+    """Bring one local Packages index up to date and return its path.
+
+    local_template.format(suffix) names the local copy of Packages{suffix}.
+    The encoding is picked by index_formats and policy, and open_index
+    later streams it straight into the stanza parser.
+
+    With a Release file the expected SHA256/size of each index is known:
+    a matching local copy is used without any request and every download
+    is verified. When the suite publishes Packages.diff the index is kept
+    uncompressed and moved forward by applying pdiffs, with a full
+    download as the fallback. Otherwise the preferred encodings are
+    revalidated with conditional requests, skipping those the mirror does
+    not have.
+    """
+    release = release or {}
+    formats = index_formats(rel_path, release, policy)
+    plain_file = local_template.format("")
+    use_pdiff = f"{rel_path}/Packages.diff/Index" in release and f"{rel_path}/Packages" in release
+
+    if offline:
+        for ext in ([""] if use_pdiff else []) + formats:
+            if os.path.exists(local_template.format(ext)):
+                return local_template.format(ext)
+
+    if use_pdiff:
+        expected = release[f"{rel_path}/Packages"]
+
+        if os.path.exists(plain_file):
+            if file_digest(plain_file) == expected[0]:
+                return plain_file
+
+            try:
+                if apply_pdiffs(url, plain_file, download_dir):
+                    verify_file(plain_file, expected)
+                    return plain_file
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                logging.warning(f"Failed to apply pdiffs to {plain_file}, downloading in full: {e}")
+
+        ext = formats[0]
+        filename = local_template.format(ext)
+        fetch_url(f"{url}/Packages{ext}", filename, conditional=False)
+
+        if ext:
+            verify_file(filename, release[f"{rel_path}/Packages{ext}"])
+            with open_index(filename) as src:
+                atomic_write(plain_file, lambda f: shutil.copyfileobj(src, f, 1 << 20))
+        verify_file(plain_file, expected)
+
+        return plain_file
+
+    if f"{rel_path}/Packages{formats[0]}" in release:
+        for ext in formats:
+            filename = local_template.format(ext)
+            if os.path.exists(filename) and file_digest(filename) == release[f"{rel_path}/Packages{ext}"][0]:
+                return filename
+
+        ext = formats[0]
+        filename = local_template.format(ext)
+
+        try:
+            fetch_url(f"{url}/Packages{ext}", filename, conditional=False)
+        except (urllib.error.URLError, OSError) as e:
+            if not os.path.exists(filename):
+                raise
+
+            logging.warning(f"Failed to refresh {filename}, using local copy: {e}")
+            return filename
+
+        verify_file(filename, release[f"{rel_path}/Packages{ext}"])
+        return filename
+
+    for ext in formats:
+        filename = local_template.format(ext)
+
+        try:
+            fetch_url(f"{url}/Packages{ext}", filename)
+        except urllib.error.HTTPError as e:
+            if e.code == 404 and not os.path.exists(filename):
+                continue
+            if not os.path.exists(filename):
+                raise
+
+            logging.warning(f"Failed to refresh {filename}, using local copy: {e}")
+        except (urllib.error.URLError, OSError) as e:
+            if not os.path.exists(filename):
+                raise
+
+            logging.warning(f"Failed to refresh {filename}, using local copy: {e}")
+
+        return filename
+
+    raise FileNotFoundError(f"No Packages index under {url}")
+
+
+# apt's default is 500 for everything; like apt, suites that should only
+# be used on request (NotAutomatic in their Release) sit lower
+DEFAULT_PINS = {"backports": 100, "proposed": 100}
+
+
+def suite_dist(repo, suite):
+    """The dists/ directory of suite: "release" is the distro itself, others are distro-suite."""
+    return repo["distro"] if suite == "release" else f"{repo['distro']}-{suite}"
+
+
+def repo_targets(user_config):
+    """Yield (repo, suite, dist, component, arch, url) for every index in user_config, in order."""
     for repo in user_config:
         for suite in repo["suites"]:
+            dist = suite_dist(repo, suite)
+
             for component in repo["components"]:
                 for arch in repo["archs"]:
-                    url = f"{repo['repo_url']}/dists/{repo['distro']}/{component}/binary-{arch}"
+                    url = f"{repo['repo_url']}/dists/{dist}/{component}/binary-{arch}"
+                    yield (repo, suite, dist, component, arch, url)
+
+
+def native_arch(user_config):
+    """The first architecture user_config lists, which apt would treat as native."""
+    return next((arch for _, _, _, _, arch, _ in repo_targets(user_config)), "")
 
-                    index.update({url: {"file": str(uuid.uuid4())}})
-                    if not os.path.exists(f"Packages.gz.{suite}-{component}-{arch}"):
-                        filename = wget.download(f"{url}/Packages.gz")
-                        os.rename("Packages.gz", f"Packages.gz.{suite}-{component}-{arch}")
 
-                    index[url]["index"] = parse_package_gz(f"Packages.gz.{suite}-{component}-{arch}", url)
-                    package_list.extend(index[url]["index"])
+def repo_pins(user_config):
+    """Map each index URL to its pin priority.
 
-                    if not os.path.exists(f"Packages.gz.{suite}-{component}-{arch}.json"):
-                        with open(f"Packages.gz.{suite}-{component}-{arch}.json", 'w') as f:
-                            json.dump(index[url]["index"], f, indent=4)
+    A repo entry may carry "pins": {suite: priority}; anything not listed
+    falls back to DEFAULT_PINS and then to apt's 500.
+    """
+    return {
+        url: repo.get("pins", {}).get(suite, DEFAULT_PINS.get(suite, 500))
+        for repo, suite, _, _, _, url in repo_targets(user_config)
+    }
+
+
+def index_targets(user_config, download_dir, releases):
+    """Return the (url, local_template, rel_path, release) of every index, in config order.
+
+    These are sync_index's leading arguments. releases maps each
+    (repo_url, dist) to what fetch_release returned for it.
+    """
+    return [
+        (url, os.path.join(download_dir, "Packages{}." + f"{dist}-{component}-{arch}"), f"{component}/binary-{arch}",
+         releases[(repo["repo_url"], dist)])
+        for repo, suite, dist, component, arch, url in repo_targets(user_config)
+    ]
+
+
+def fetch_repo_files(user_config, download_dir=".", jobs=8, offline=False, compression="smallest"):
+    """Fetch every suite/component/arch Packages index concurrently.
+
+    Returns [(url, filename), ...] in config order. Each suite's InRelease
+    or Release is read first and drives validation and pdiff updates, see
+    sync_index. Without one, files already on disk are revalidated with a
+    conditional request unless offline is set, and an existing local copy
+    is used as is if the mirror cannot be reached. compression picks
+    between the encodings a suite offers, see index_formats.
+    """
+    with metrics.span("fetch"):
+        os.makedirs(download_dir, exist_ok=True)
+
+        releases = {}
+        for repo, suite, dist, component, arch, url in repo_targets(user_config):
+            if (repo["repo_url"], dist) not in releases:
+                releases[(repo["repo_url"], dist)] = fetch_release(repo, dist, download_dir, offline)
+
+        targets = index_targets(user_config, download_dir, releases)
 
-                    #os.remove(filename)
+        # The same index listed twice in the config is only fetched once
+        pending = {}
+        for target in targets:
+            pending.setdefault(target[1], target)
 
-    return (index, package_list)
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            synced = {
+                local_template: pool.submit(sync_index, *target, download_dir, offline, compression)
+                for local_template, target in pending.items()
+            }
+            synced = {local_template: future.result() for local_template, future in synced.items()}
 
+    return [(target[0], synced[target[1]]) for target in targets]
 
-def build_index(pkgs):
+
+def get_repo_contents(user_config, files=None, state_dir=None):
     index = {}
+    for url, filename in (files if files is not None else fetch_repo_files(user_config)):
+        index.update({url: {"file": str(uuid.uuid4())}})
+        index[url]["index"] = load_packages(filename, url, state_dir)
+
+    with metrics.span("merge"):
+        return (index, merge_indices(index, repo_pins(user_config)))
+
+
+def merge_indices(index, pins):
+    """Flatten the per-URL records of index into one package list without duplicates.
+
+    The same stanza published in several suites (identical Package,
+    Version, Architecture and SHA256) is kept once, from the source with
+    the highest pin, or the first listed on a tie. Every record gets the
+    pin of the source it was kept from.
+    """
+    merged = {}
+
+    for url, contents in index.items():
+        pin = pins.get(url, 500)
+
+        for p in contents["index"]:
+            key = (p.name, p.version, p.arch, p.sha256)
+            kept = merged.get(key)
+
+            if kept is None or pin > kept.pin:
+                p.pin = pin
+                merged[key] = p
+
+    return list(merged.values())
+
+
+class CandidateIndex(dict):
+    """build_index's map of names to candidates, narrowed by dpkg's Multi-Arch rules in candidates()."""
+
+    __module__ = "deb_deps"
+
+    def __init__(self, native=""):
+        super().__init__()
+        self.native = native
+        self.multiarch = False
+        self._by_arch = {}
+
+    def effective_arch(self, arch):
+        # The architecture a record or depender really is
+        return self.native if arch in ("", "all") else arch
+
+    def target(self, dep, arch=""):
+        """The architecture dep asks for when a package of arch depends on it."""
+        if dep.arch in ("", "any"):
+            return self.effective_arch(arch)
+        if dep.arch == "native":
+            return self.native
+        return dep.arch
+
+    def candidates(self, dep, arch=""):
+        """Return the candidates for dep from a package of arch, best first, or None."""
+        found = self.get(dep.name)
+        if not found or not self.multiarch:
+            return found
+
+        # An unqualified root is the only dependency that may fall back
+        key = (dep.name, self.target(dep, arch), dep.arch == "any", not arch and not dep.arch)
+        try:
+            return self._by_arch[key]
+        except KeyError:
+            pass
+
+        _, target, any_arch, fallback = key
+        narrowed = [
+            c for c in found
+            if c.multi_arch == "foreign" or (any_arch and c.multi_arch == "allowed")
+            or self.effective_arch(c.arch) == target
+        ]
+        if not narrowed and fallback:
+            narrowed = found
+
+        self._by_arch[key] = narrowed
+        return narrowed
+
+    def preferred(self, pkg_inst):
+        """Whether pkg_inst is the version apt would pick for its name and architecture."""
+        if not self.multiarch:
+            return self[pkg_inst.name][0] is pkg_inst
+
+        arch = self.effective_arch(pkg_inst.arch)
+        return next(c for c in self[pkg_inst.name] if self.effective_arch(c.arch) == arch) is pkg_inst
+
+
+def build_index(pkgs, native=""):
+    """Return the CandidateIndex of pkgs.
+
+    native is the architecture Architecture: all packages and unqualified
+    root dependencies count as, by default the most common one in pkgs.
+    When pkgs hold more than one, every Multi-Arch: same package of a
+    foreign architecture gets "name:arch" as its key, so it can sit in a
+    closure next to its native counterpart.
+    """
+    archs = Counter(p.arch for p in pkgs)
+    archs.pop("all", None)
+    archs.pop("", None)
+
+    index = CandidateIndex(native or (archs.most_common(1)[0][0] if archs else ""))
+    index.multiarch = len(archs) > 1
 
     for p in pkgs:
-        if not p["Package"] in index.keys():
-            index[p["Package"]] = []
+        if index.multiarch and p.multi_arch == "same" and index.effective_arch(p.arch) != index.native:
+            p.key = intern(f"{p.name}:{p.arch}")
+        else:
+            p.key = p.name
 
-        index[p["Package"]].append(p)
+        if not p.name in index:
+            index[p.name] = []
 
-        provides = re.sub(", ", ",", p["Provides"]).split(",") if "Provides" in p.keys() else []
+        index[p.name].append(p)
 
-        for pro in provides:
-            if not pro in index.keys():
+        for pro in p.provides:
+            if not pro in index:
                 index[pro] = []
-                index[pro].append(p)
+
+            index[pro].append(p)
+
+    # Real packages of each name first, then providers, each by pin and
+    # within a pin newest version first, so candidates[0] is what apt would
+    # pick. Sorting once here lets satisfying bisect version constraints.
+    pin = attrgetter("pin")
+    for name, candidates in index.items():
+        real = [p for p in candidates if p.name == name]
+        if len(real) > 1:
+            real = sorted(newest_first(real), key=pin, reverse=True)
+        providers = sorted((p for p in candidates if p.name != name), key=pin, reverse=True)
+        candidates[:] = real + providers
 
     return index
 
 
+def build_reverse_index(index):
+    """Map each package name to the records with a dependency it could satisfy.
+
+    Every alternative of a group counts. Unversioned dependencies count
+    every candidate build_index lists for
+    the name, so all providers of a virtual package are included;
+    versioned ones only the real packages whose version matches. Reading
+    every record's depends defeats their lazy parsing, so this is only
+    built for queries, not on the resolve path.
+    """
+    rindex = defaultdict(list)
+
+    for name, candidates in index.items():
+        for p in candidates:
+            if p.name != name:
+                continue
+
+            targets = set()
+            for dep in chain.from_iterable(p.alternatives):
+                found = index.candidates(dep, p.arch) or ()
+                if not dep.version:
+                    targets.update(c.name for c in found)
+                elif satisfying(found, dep):
+                    targets.add(dep.name)
+
+            targets.discard(p.name)
+            for target in targets:
+                rindex[target].append(p)
+
+    return dict(rindex)
+
+
+# Bump whenever PackageRecord or the cached tuple layout changes so stale
+# caches are ignored rather than unpickled into the wrong shape.
+INDEX_CACHE_VERSION = 7
+
+_digest_memo = {}
+
+
+def file_digest(filename):
+    # Indices are hashed by the fetcher, the stanza state and the index
+    # cache key; only hash each (path, size, mtime) once per process
+    st = os.stat(filename)
+    memo_key = (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+
+    if memo_key in _digest_memo:
+        metrics.count("digest_cache_hits")
+    else:
+        h = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+
+        _digest_memo[memo_key] = h.hexdigest()
+
+    return _digest_memo[memo_key]
+
+
+def load_repo_index(user_config, cache_dir="index-cache", files=None, **fetch_args):
+    """Return (index, package_list, bindex) for user_config.
+
+    The parsed and indexed result is pickled to cache_dir under a key made
+    from the SHA256 of every local index file (plus the pins and
+    INDEX_CACHE_VERSION). A warm start still hashes the source
+    files and unpickles the whole index: around a second on a full Debian
+    main archive, against about four for a cold load. Any upstream
+    change gives a new key, and only the stanzas that changed are re-parsed
+    (see load_packages) before build_index runs again.
+
+    Cache files are named index-<source>-<key>.pickle, where source covers
+    everything in the key but the file digests, and writing a new one
+    removes the older ones of the same source (and any of the unprefixed
+    index-<key>.pickle layout), so a cache_dir shared by several
+    configurations keeps one index for each. Passing cache_dir=None
+    disables the cache. files takes the result of an earlier
+    fetch_repo_files, otherwise any other keyword arguments go to
+    fetch_repo_files.
+    """
+    files = files if files is not None else fetch_repo_files(user_config, **fetch_args)
+
+    source = hashlib.sha256(str(INDEX_CACHE_VERSION).encode())
+    source.update(repr(sorted(repo_pins(user_config).items())).encode())
+    source.update(repr([url for url, _ in files]).encode())
+    source = source.hexdigest()[:16]
+
+    key = hashlib.sha256(source.encode())
+    for url, filename in files:
+        key.update(f"{url} {file_digest(filename)}\n".encode())
+
+    cache_file = os.path.join(cache_dir, f"index-{source}-{key.hexdigest()}.pickle") if cache_dir else None
+
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with metrics.span("index_cache_load"), open(cache_file, "rb") as f:
+                loaded = pickle.load(f)
+            metrics.count("index_cache_hits")
+            return loaded
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable index cache {cache_file}: {e}")
+
+    index, package_list = get_repo_contents(user_config, files, cache_dir)
+    with metrics.span("index"):
+        bindex = build_index(package_list, native_arch(user_config))
+
+    if cache_file:
+        write_pickle(cache_file, (index, package_list, bindex))
+
+        if os.path.exists(cache_file):
+            stale = re.compile(rf"index-({source}-[0-9a-f]{{64}}|[0-9a-f]{{64}})\.pickle")
+            for name in os.listdir(cache_dir):
+                if stale.fullmatch(name) and name != os.path.basename(cache_file):
+                    try:
+                        os.remove(os.path.join(cache_dir, name))
+                    except FileNotFoundError:
+                        pass
+
+    return (index, package_list, bindex)
+
+
 def main():
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('-p', '--packages', help='JSON file containing list of packages to bootstrap')
     parser.add_argument("-r", "--repos", help="Config file for bootstrap")
+    parser.add_argument("--cache-dir", default="index-cache", help="Directory for the parsed index cache")
+    parser.add_argument("--no-cache", action="store_true", help="Always re-parse Packages files")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="Number of concurrent downloads")
+    parser.add_argument("--compression", choices=["smallest", "fastest"], default="smallest", help="Fetch the smallest Packages encoding a suite offers, or the cheapest to decompress")
+    parser.add_argument("--offline", action="store_true", help="Use local Packages files without revalidating them")
+    parser.add_argument("--benchmark", action="store_true", help="Time resolving the closure of the whole archive")
+    parser.add_argument("--rootfs", help="Download and unpack the resolved packages into this directory")
+    parser.add_argument("--download-dir", default="debs", help="Where downloaded .deb files are kept")
+    parser.add_argument("--workers", type=int, default=None, help="Number of unpack processes (default: CPU count), or of --batch resolve processes (default: 1)")
+    parser.add_argument("--artifact-cache", help="Shared content-addressed cache of .deb files and extracted trees")
+    parser.add_argument("--artifact-cache-size", type=int, default=10, help="Artifact cache size limit in GiB")
+    parser.add_argument("--link-mode", choices=["reflink", "hardlink"], default="reflink", help="How roots are populated from the artifact cache: copy-on-write clones (plain copies where unsupported), or hardlinks sharing inodes with the cache")
+    parser.add_argument("--snapshots", help="Keep a rootfs snapshot per install layer here and start builds from the largest matching one")
+    parser.add_argument("--snapshot-size", type=int, default=20, help="Snapshot store size limit in GiB of Installed-Size")
+    parser.add_argument("--lock", help="Lockfile of the resolved closure, reused while packages and indices are unchanged")
+    parser.add_argument("--verify-lock", action="store_true", help="Check the --lock closure against the current indices and exit")
+    parser.add_argument("--serve", metavar="SOCKET", help="Keep the index loaded and answer resolve requests on this Unix socket")
+    parser.add_argument("--reload-interval", type=int, default=300, help="Seconds between index refresh checks when serving")
+    parser.add_argument("--connect", metavar="SOCKET", help="Resolve through a server started with --serve")
+    parser.add_argument("--alternatives", action="store_true", help="Choose between | alternatives and honour Conflicts/Breaks instead of always taking the first alternative")
+    parser.add_argument("--what-depends", action="append", metavar="NAME", help="List what depends on NAME in the closure and in the whole archive")
+    parser.add_argument("--why", action="append", metavar="NAME", help="Show the shortest dependency chain from a requested package to NAME")
+    parser.add_argument("--removal-size", action="append", metavar="NAME", help="Show what dropping NAME would remove and the Installed-Size saved")
+    parser.add_argument("--batch", nargs="+", metavar="FILE", help="Resolve several package list files (same format as -p) in one run")
+    parser.add_argument("--async", action="store_true", help="Fetch, resolve and build (every --batch root at once) on one asyncio event loop")
+    parser.add_argument("--per-host", type=int, default=4, help="Concurrent requests per mirror host with --async")
+    parser.add_argument("--retries", type=int, default=3, help="Retries of a transiently failing request with --async")
+    parser.add_argument("--window", type=int, default=64, help="Packages downloaded but not yet extracted at once with --async")
+    parser.add_argument("--log-level", choices=["debug", "info", "warning", "error"], default="warning", help="info also logs the metrics summary, debug every span as it ends")
+    parser.add_argument("--metrics", metavar="FILE", help="Collect stage timings and counters and write them as JSON to FILE (- for stdout)")
+    parser.add_argument("--profile", nargs="?", const="-", metavar="FILE", help="Run under cProfile, printing the top functions or saving pstats data to FILE")
 
     args  = parser.parse_args()
     vargs = vars(args)
-    debian_packages = dict()
-    debian_packages_basic = dict()
 
-    apt_pkg.init_system()
+    if vargs["async"]:
+        unsupported = [f"--{key.replace('_', '-')}" for key in
+                       ("serve", "connect", "lock", "benchmark", "what_depends", "why", "removal_size") if vargs[key]]
+        if unsupported:
+            parser.error(f"--async cannot be combined with {' '.join(unsupported)}")
+
+    logging.basicConfig(level=vargs["log_level"].upper(), stream=sys.stderr,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if vargs["metrics"] or vargs["log_level"] in ("debug", "info"):
+        enable_metrics()
+
+    profiler = cProfile.Profile() if vargs["profile"] else None
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        with metrics.span("total"):
+            return run(vargs)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            write_profile(profiler, vargs["profile"])
+
+        if metrics.enabled:
+            metrics.log()
+
+        if vargs["metrics"]:
+            write_metrics(vargs["metrics"])
+
+
+def write_profile(profiler, filename):
+    if filename == "-":
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(30)
+    else:
+        profiler.dump_stats(filename)
+
+
+def write_metrics(filename):
+    data = json.dumps(metrics.snapshot(), indent=4)
 
+    if filename == "-":
+        print(data)
+    else:
+        atomic_write(filename, lambda f: f.write(data.encode()))
+
+
+def run(vargs):
     with open(vargs["repos"], "r") as f:
        config = json.load(f)
 
-    with open(vargs["packages"], "r") as f:
-       packages = json.load(f)
+    if vargs["serve"]:
+        load_args = {"cache_dir": None if vargs["no_cache"] else vargs["cache_dir"]}
+        fetch_args = {"jobs": vargs["jobs"], "offline": vargs["offline"], "compression": vargs["compression"]}
 
-    # Get Dict of all packages in relevant Packages.gz files
+        debserver = load_script("deb-server")
+        debserver.ResolverServer(vargs["serve"], config, load_args, fetch_args, vargs["reload_interval"],
+                                 vargs["alternatives"]).serve()
+        return
 
-    index = get_repo_contents(config)
-    with open(vargs["packages"], "r") as f:
-       packages = json.load(f)
+    if vargs["async"]:
+        return run_async(vargs, config)
 
-    bindex = build_index(index[1])
+    if vargs["batch"]:
+        targets = [read_package_list(filename) for filename in vargs["batch"]]
 
-    deps = []
+        files = fetch_repo_files(config, jobs=vargs["jobs"], offline=vargs["offline"], compression=vargs["compression"])
+        bindex = load_index(config, vargs, files)[2]
 
-    packages = [
-        {"name": "curl", "version": "", "version_test": ""},
-        {"name": "bash", "version": "", "version_test": ""},
-        {"name": "terminator", "version": "", "version_test": ""}
-    ]
+        with metrics.span("resolve"):
+            closures = resolve_batch(targets, bindex, workers=vargs["workers"])
 
-    for pkg in packages:
-        build_deps(pkg, deps, bindex)
+        for filename, deps in zip(vargs["batch"], closures):
+            print(f"{filename}: {[x.key for x in deps]}")
+        return
 
-    print([x["Package"] for x in deps])
+    packages = read_package_list(vargs["packages"])
+
+    deps = None
+    dependency_map = None
+    bindex = None
+
+    queries = vargs["what_depends"] or vargs["why"] or vargs["removal_size"]
+
+    if vargs["connect"]:
+        response = load_script("deb-server").request_resolve(vargs["connect"], packages, vargs["alternatives"])
+        deps, dependency_map = closure_from_lock(response)
+        # The server sends the closure, but queries still look the roots
+        # and archive-wide reverse dependencies up in a local index
+        files = fetch_repo_files(config, jobs=vargs["jobs"], offline=vargs["offline"],
+                                 compression=vargs["compression"]) if queries else []
+    else:
+        files = fetch_repo_files(config, jobs=vargs["jobs"], offline=vargs["offline"], compression=vargs["compression"])
+
+    if vargs["lock"] and not vargs["benchmark"] and deps is None:
+        key = lock_key(packages, files, vargs["alternatives"], repo_pins(config))
+        lock = read_lock(vargs["lock"])
+
+        if vargs["verify_lock"]:
+            if lock is None:
+                print(f"No lock at {vargs['lock']}")
+                return 1
+
+            missing, upgradable = verify_lock(lock, load_index(config, vargs, files)[2])
+            print(f"Lock {'matches' if lock['key'] == key else 'predates'} the current indices")
+            if upgradable:
+                print(f"Newer versions available: {' '.join(upgradable)}")
+            if missing:
+                print(f"No longer in the indices: {' '.join(missing)}")
+                return 1
+            return
+
+        if lock is not None and lock["key"] == key:
+            deps, dependency_map = closure_from_lock(lock)
+            metrics.count("lock_hits")
+
+    if deps is None:
+        # Get Dict of all packages in relevant Packages files
+        bindex = load_index(config, vargs, files)[2]
+
+        if vargs["benchmark"]:
+            benchmark_resolve(bindex)
+            return
+
+        with metrics.span("resolve"):
+            deps = (resolve_alternatives if vargs["alternatives"] else resolve)(packages, bindex)
+
+        if vargs["lock"]:
+            write_lock(vargs["lock"], key, packages, deps, bindex)
+
+    print([x.key for x in deps])
+
+    if queries:
+        if bindex is None:
+            bindex = load_index(config, vargs, files)[2]
+        if dependency_map is None:
+            dependency_map = closure_dependency_map(deps, bindex)
+
+        selected = {p.key: p for p in deps}
+        roots = [pkg_inst.key for pkg_inst in (select_candidate(p, bindex, selected) for p in packages) if pkg_inst]
+        query = ClosureQuery(roots, deps, dependency_map)
+
+        rindex = build_reverse_index(bindex) if vargs["what_depends"] else {}
+        for name in vargs["what_depends"] or ():
+            rdeps = sorted({p.name for p in rindex.get(name, ())})
+            print(f"what-depends {name}: closure {query.what_depends(name)} archive {rdeps}")
+        for name in vargs["why"] or ():
+            path = query.why(name)
+            print(f"why {name}: {' -> '.join(path) if path else 'not in the closure'}")
+        for name in vargs["removal_size"] or ():
+            size, freed = query.removal_size(name)
+            print(f"removal-size {name}: {size} KiB {freed}")
+
+    if vargs["rootfs"]:
+        cache, snapshots = artifact_stores(vargs)
+
+        with metrics.span("rootfs"):
+            build_rootfs(deps, bindex, vargs["rootfs"], vargs["download_dir"], vargs["jobs"], vargs["workers"], cache,
+                         dependency_map, snapshots)
 
     return
 
 
+def package_dependency(p):
+    # One {"name", "version_test", "version"} entry of a package list; the
+    # name may carry an architecture qualifier like any relation
+    name, _, arch = p["name"].partition(":")
+    return Dependency(name, p.get("version_test", ""), p.get("version", ""), p.get("arch", arch))
+
+
+def read_package_list(filename):
+    with open(filename, "r") as f:
+        return [package_dependency(p) for p in json.load(f)]
+
+
+def artifact_stores(vargs):
+    debstores = load_script("deb-stores")
+
+    cache = None
+    if vargs["artifact_cache"]:
+        cache = debstores.ArtifactCache(vargs["artifact_cache"], vargs["artifact_cache_size"] << 30, vargs["link_mode"])
+
+    snapshots = None
+    if vargs["snapshots"]:
+        snapshots = debstores.SnapshotStore(vargs["snapshots"], vargs["snapshot_size"] << 30)
+
+    return (cache, snapshots)
+
+
+def run_async(vargs, config):
+    # -p with --rootfs builds one root; --batch builds one root per file,
+    # named after it, under the --rootfs directory, all at the same time
+    if vargs["batch"]:
+        names = vargs["batch"]
+        roots = [
+            os.path.join(vargs["rootfs"], os.path.splitext(os.path.basename(name))[0]) if vargs["rootfs"] else None
+            for name in names
+        ]
+    else:
+        names = [vargs["packages"]]
+        roots = [vargs["rootfs"]]
+
+    cache, snapshots = artifact_stores(vargs)
+
+    closures = load_script("deb-engine").bootstrap(
+        config,
+        [(read_package_list(name), root) for name, root in zip(names, roots)],
+        download_dir=vargs["download_dir"],
+        cache_dir=None if vargs["no_cache"] else vargs["cache_dir"],
+        jobs=vargs["jobs"],
+        workers=vargs["workers"],
+        per_host=vargs["per_host"],
+        retries=vargs["retries"],
+        window=vargs["window"],
+        offline=vargs["offline"],
+        compression=vargs["compression"],
+        alternatives=vargs["alternatives"],
+        cache=cache,
+        snapshots=snapshots
+    )
+
+    if not vargs["batch"]:
+        print([x.key for x in closures[0]])
+        return
+
+    for name, deps in zip(names, closures):
+        print(f"{name}: {[x.key for x in deps]}")
+
+
+def load_index(config, vargs, files):
+    return load_repo_index(config, None if vargs["no_cache"] else vargs["cache_dir"], files)
+
+
+def _order(c):
+    # dpkg's character weight: "~" sorts before everything, even the end of
+    # the string, letters before all other non-digits
+    if c == "~":
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+
+def _verrevcmp(a, b):
+    i = j = 0
+
+    while i < len(a) or j < len(b):
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac = _order(a[i]) if i < len(a) and not a[i].isdigit() else 0
+            bc = _order(b[j]) if j < len(b) and not b[j].isdigit() else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+
+        while i < len(a) and a[i] == "0":
+            i += 1
+        while j < len(b) and b[j] == "0":
+            j += 1
+
+        first_diff = 0
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+
+    return 0
+
+
+def _split_version(v):
+    epoch, _, rest = v.partition(":") if ":" in v else ("0", "", v)
+    upstream, _, revision = rest.rpartition("-") if "-" in rest else (rest, "", "")
+
+    return (int(epoch or 0), upstream, revision)
+
+
+def debian_version_compare(a, b):
+    """Pure-Python port of dpkg's version comparison, <0, 0 or >0."""
+    a_epoch, a_upstream, a_revision = _split_version(a)
+    b_epoch, b_upstream, b_revision = _split_version(b)
+
+    if a_epoch != b_epoch:
+        return a_epoch - b_epoch
+
+    return _verrevcmp(a_upstream, b_upstream) or _verrevcmp(a_revision, b_revision)
+
+
+@lru_cache(maxsize=1 << 16)
+def version_compare(a, b):
+    if apt_pkg is not None:
+        return apt_pkg.version_compare(a, b)
+
+    return debian_version_compare(a, b)
+
+
+def newest_first(items, get=attrgetter("version")):
+    return sorted(items, key=cmp_to_key(lambda a, b: version_compare(get(b), get(a))))
+
+
+def _bisect(items, lo, hi, pred):
+    # First index in [lo, hi) where pred holds, pred being false then true
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if pred(items[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+
+    return lo
+
+
+def version_range(candidates, test, version, lo=0, hi=None, get=attrgetter("version")):
+    """Return (start, stop) of the candidates meeting "<test> <version>".
+
+    candidates[lo:hi] must be sorted newest first (see newest_first), so
+    every relation is a contiguous run found with two bisections rather
+    than a comparison per candidate.
+    """
+    hi = len(candidates) if hi is None else hi
+
+    not_newer = _bisect(candidates, lo, hi, lambda c: version_compare(get(c), version) <= 0)
+    older = _bisect(candidates, not_newer, hi, lambda c: version_compare(get(c), version) < 0)
+
+    if test == ">=":
+        return (lo, older)
+    if test in (">>", ">"):
+        return (lo, not_newer)
+    if test == "<=":
+        return (not_newer, hi)
+    if test in ("<<", "<"):
+        return (older, hi)
+    if test in ("=", "==", ""):
+        return (not_newer, older)
+
+    return (lo, lo)
+
+
 class AptVerChk():
     lookup = {
         "<": lambda x: x < 0,
@@ -237,54 +1606,935 @@ class AptVerChk():
 
     @classmethod
     def compare(cls, a, sym, b):
-        comp = apt_pkg.version_compare(a, b)
+        comp = version_compare(a, b)
 
         return cls.lookup[sym](comp) if sym in cls.lookup.keys() else False
 
 
-def build_deps(package, deps, index, dep_stack=[]):
-    # print(f"Root Dep {package['name']}: {dep_stack}")
-    # print(dep_stack)
+def satisfying(candidates, dep):
+    """Return the real packages among candidates meeting versioned dep, best first.
 
-    if package["name"] in index.keys():
-        found = False
-        for pkg_inst in index[package["name"]]:
-            #print(pkg_inst["Package"])
-            
-            if len(package['version']) > 0:
-                if not AptVerChk.compare(pkg_inst['Version'], package['version_test'], package['version']):
-                    raise ValueError(f"Cant find version match for {package['name']}, {pkg_inst['Version']} {package['version_test']} {package['version']}")
-                else:
-                    found = True
+    build_index keeps them at the front of each list, highest pin first
+    and newest first within a pin, so every pin band is bisected on its own.
+    """
+    if metrics.enabled:
+        metrics.count("version_scans")
 
-            if pkg_inst["Package"] in dep_stack:
-                # print("Cyclic")
-                if found:
-                    break
+    real = _bisect(candidates, 0, len(candidates), lambda c: c.name != dep.name)
+    found = []
+
+    lo = 0
+    while lo < real:
+        pin = candidates[lo].pin
+        hi = _bisect(candidates, lo, real, lambda c: c.pin != pin)
+        start, stop = version_range(candidates, dep.version_test, dep.version, lo, hi)
+        found.extend(candidates[start:stop])
+        lo = hi
+
+    return found
+
+
+def select_candidate(package, index, selected=None, arch=""):
+    """Return the record that satisfies the Dependency package, None if none does.
+
+    arch is the architecture of the package depending on it, see
+    CandidateIndex.candidates. A candidate already in selected (keyed by
+    record key) is preferred, otherwise the best pinned candidate
+    meeting the version constraint whose key has no other record selected.
+    Versioned relations are only satisfied by real packages, found by
+    bisecting the sorted versions build_index keeps at the front of each
+    candidate list.
+    """
+    candidates = index.candidates(package, arch)
+    if metrics.enabled:
+        metrics.count("candidate_lookups")
+        metrics.count("candidates_examined", len(candidates or ()))
+
+    if not candidates:
+        return None
+
+    if selected:
+        # Real packages come first, so one of the same name wins over providers
+        for pkg_inst in candidates:
+            if selected.get(pkg_inst.key) is pkg_inst:
+                if not package.version:
+                    return pkg_inst
+                if pkg_inst.name == package.name and \
+                        AptVerChk.compare(pkg_inst.version, package.version_test, package.version):
+                    return pkg_inst
+
+    found = satisfying(candidates, package) if package.version else candidates
+
+    if selected:
+        # A closure holds one record per key, so lib (<< 2) cannot add lib 1 next to lib 2
+        return next((c for c in found if selected.get(c.key, c) is c), None)
+
+    return found[0] if found else None
+
+
+def unresolvable(package, index, arch=""):
+    if package.name not in index:
+        return ValueError(f"Package not found {package.name}")
+    if not index.candidates(package, arch):
+        return ValueError(f"Package not found {package.name} for {index.target(package, arch)}")
+    return ValueError(f"Cant find version match for {package.name} {package.version_test} {package.version}")
+
+
+def resolve(packages, index, strict=True):
+    """Return the dependency closure of packages (Dependency tuples) in visit order.
+
+    Depth-first and pre-order over an explicit stack, holding one record
+    per key. A dependency only the other versions of an already selected
+    key would meet is unresolvable: ValueError, or skipped with strict=False.
+    """
+    deps = []
+    visited = set()
+    selected = {}
+    stack = [(package, "") for package in reversed(packages)]
+
+    while stack:
+        package, arch = stack.pop()
+        pkg_inst = select_candidate(package, index, selected, arch)
+
+        if pkg_inst is None:
+            if not strict:
+                continue
+            raise unresolvable(package, index, arch)
+
+        if id(pkg_inst) in visited:
+            continue
+
+        visited.add(id(pkg_inst))
+        selected.setdefault(pkg_inst.key, pkg_inst)
+        deps.append(pkg_inst)
+
+        stack.extend(zip(reversed(pkg_inst.depends), repeat(pkg_inst.arch)))
+
+    return deps
+
+
+def satisfies(pkg_inst, dep):
+    """Whether pkg_inst meets dep by name and version, or unversioned through Provides."""
+    if pkg_inst.name == dep.name:
+        return not dep.version or AptVerChk.compare(pkg_inst.version, dep.version_test, dep.version)
+
+    return not dep.version and dep.name in pkg_inst.provides
+
+
+def resolve_alternatives(packages, index, strict=True, max_steps=100000):
+    """Resolve packages honouring | alternatives, Conflicts and Breaks, backjumping on dead ends.
+
+    max_steps bounds the backjumps; with strict=False unsatisfiable groups are skipped.
+    """
+    selected = {}
+    provided = defaultdict(list)
+    forbidden = defaultdict(list)
+    levels = {}
+    order = []
+    choices = []
+    matches_memo = {}
+    dead = {}
+    steps = 0
+
+    # A linked stack of ((group, requirer), rest) cells, so choice points
+    # can save it without copying
+    agenda = None
+    for package in reversed(packages):
+        agenda = (((package,), None), agenda)
+
+    def matches(dep, arch):
+        try:
+            return matches_memo[dep, arch]
+        except KeyError:
+            pass
+
+        candidates = index.candidates(dep, arch) or ()
+        if dep.version:
+            candidates = satisfying(candidates, dep)
+        else:
+            # Like apt, only the preferred version of each name is a
+            # candidate unless a version constraint asks for something else
+            candidates = [c for c in candidates if index.preferred(c)]
+
+        matches_memo[dep, arch] = candidates
+        return candidates
+
+    def satisfied(group, arch):
+        for dep in group:
+            for pkg_inst in index.candidates(dep, arch) or ():
+                if selected.get(pkg_inst.key) is pkg_inst and satisfies(pkg_inst, dep):
+                    return True
+        return False
+
+    def is_dead(pkg_inst):
+        # Dead when some group only has dead candidates (or none at all).
+        # Everything reachable starts out alive and is knocked out until
+        # nothing changes, so records on a cycle only stay alive if the
+        # cycle can really be installed together.
+        if id(pkg_inst) in dead:
+            return dead[id(pkg_inst)]
+
+        reached = {id(pkg_inst): pkg_inst}
+        stack = [pkg_inst]
+        while stack:
+            node = stack.pop()
+            for group in node.alternatives:
+                for dep in group:
+                    for c in matches(dep, node.arch):
+                        if id(c) not in dead and id(c) not in reached:
+                            reached[id(c)] = c
+                            stack.append(c)
+
+        for key in reached:
+            dead[key] = False
+
+        changed = True
+        while changed:
+            changed = False
+            for key, node in reached.items():
+                if not dead[key] and any(all(dead[id(c)] for dep in group for c in matches(dep, node.arch))
+                                         for group in node.alternatives):
+                    dead[key] = changed = True
+
+        return dead[id(pkg_inst)]
+
+    def blocker(pkg_inst):
+        # The selected record ruling pkg_inst out, pkg_inst itself if it
+        # can never be installed, None if it may be selected
+        other = selected.get(pkg_inst.key)
+        if other is not None:
+            return other
+        if strict and is_dead(pkg_inst):
+            return pkg_inst
+
+        for dep, by in forbidden.get(pkg_inst.name, ()):
+            if satisfies(pkg_inst, dep):
+                return by
+        for name in pkg_inst.provides:
+            for dep, by in forbidden.get(name, ()):
+                if not dep.version:
+                    return by
+
+        for dep in pkg_inst.conflicts:
+            other = selected.get(dep.name)
+            if other is not None and satisfies(other, dep):
+                return other
+            if not dep.version and provided.get(dep.name):
+                return provided[dep.name][0]
+
+        return None
+
+    def select(pkg_inst, level):
+        selected[pkg_inst.key] = pkg_inst
+        for name in pkg_inst.provides:
+            provided[name].append(pkg_inst)
+        for dep in pkg_inst.conflicts:
+            forbidden[dep.name].append((dep, pkg_inst))
+        levels[id(pkg_inst)] = level
+        order.append(pkg_inst)
+
+    def unselect(pkg_inst):
+        # Strictly the reverse of select, so the lists can just be popped
+        del selected[pkg_inst.key]
+        for name in pkg_inst.provides:
+            provided[name].pop()
+        for dep in pkg_inst.conflicts:
+            forbidden[dep.name].pop()
+        del levels[id(pkg_inst)]
+
+    options = None
+
+    while True:
+        if options is None:
+            if agenda is None:
+                break
+
+            (group, requirer), agenda = agenda
+            arch = requirer.arch if requirer is not None else ""
+            if satisfied(group, arch):
                 continue
+
+            options = list({id(c): c for dep in group for c in matches(dep, arch)}.values())
+            if not options and not strict:
+                options = None
+                continue
+
+            position = 0
+            conflict = set()
+
+        while position < len(options):
+            culprit = blocker(options[position])
+            if culprit is None:
+                break
+            conflict.add(levels.get(id(culprit), 0))
+            position += 1
+
+        if position < len(options):
+            pkg_inst = options[position]
+            if position + 1 < len(options):
+                choices.append((len(order), agenda, group, requirer, options, position + 1, conflict))
+                level = len(choices)
             else:
-                dep_stack.append(pkg_inst["Package"])
-                if pkg_inst not in deps:
-                    deps.append(pkg_inst)
+                # Forced: only depends on what required it and what ruled
+                # out the options before it
+                level = max(conflict | {levels.get(id(requirer), 0)})
+
+            select(pkg_inst, level)
+            for alternatives in reversed(pkg_inst.alternatives):
+                agenda = ((alternatives, pkg_inst), agenda)
+
+            options = None
+            continue
+
+        conflict.add(levels.get(id(requirer), 0))
+        target = max(conflict)
+
+        if target == 0:
+            # No choice made so far has anything to do with this group
+            if not strict:
+                options = None
+                continue
+            arch = requirer.arch if requirer is not None else ""
+            if not any(matches(dep, arch) for dep in group):
+                raise unresolvable(group[0], index, arch)
+            raise ValueError(f"Nothing installable satisfies {' | '.join(dep.name for dep in group)}")
+
+        steps += 1
+        if steps > max_steps:
+            raise ValueError(f"Gave up after {max_steps} backtracks")
+
+        del choices[target:]
+        mark, agenda, group, requirer, options, position, previous = choices.pop()
+        while len(order) > mark:
+            unselect(order.pop())
+
+        conflict = previous | (conflict - {target})
+
+    return order
+
+
+def benchmark_resolve(index, steps=4):
+    """Resolve growing slices of every name in index and print the cost per edge.
+
+    With every name as a root this is the full-archive closure; roughly
+    constant microseconds per edge across the slices shows resolve scales
+    linearly with the graph it walks.
+    """
+    roots = [Dependency(name, "", "") for name in sorted(index)]
+
+    for step in range(1, steps + 1):
+        subset = roots[:len(roots) * step // steps]
+
+        start = time.perf_counter()
+        closure = resolve(subset, index, strict=False)
+        elapsed = time.perf_counter() - start
+
+        edges = len(subset) + sum(len(p.depends) for p in closure)
+        print(f"roots={len(subset)} packages={len(closure)} edges={edges} "
+              f"time={elapsed:.3f}s per_edge={elapsed / max(edges, 1) * 1e6:.2f}us")
+
+
+class BatchResolver(object):
+    """Resolve many package lists against one index, sharing work between them.
+
+    Every record's direct dependencies are matched once, into a memo
+    shared by all targets: for each dependency the record select_candidate
+    picks with nothing selected, and, when there are several, the
+    candidates it would prefer instead once one of them is selected. Each
+    target is then resolve()'s own walk over that memo, so it costs the
+    size of its closure, and picking among several candidates checks the
+    records selected so far exactly like resolve() does. The results are
+    the ones resolve() gives.
+    """
+
+    def __init__(self, index, strict=True):
+        self.index = index
+        self.strict = strict
+        self._matches = {}
+        self._children = {}
+
+    def match(self, package, arch=""):
+        """Return (best, preferred) for package depended on by a package of arch.
+
+        best is select_candidate's pick with nothing selected, preferred
+        the candidates it checks against selected first, None when best is
+        the only one.
+        """
+        try:
+            return self._matches[package, arch]
+        except KeyError:
+            pass
+
+        candidates = self.index.candidates(package, arch) or ()
+        if candidates and package.version:
+            candidates = satisfying(candidates, package)
+
+        match = self._matches[package, arch] = (
+            candidates[0] if candidates else None,
+            tuple(candidates) if len(candidates) > 1 else None
+        )
+        return match
+
+    def children(self, pkg_inst):
+        # Direct dependencies with their matches, reversed for the stack
+        try:
+            return self._children[id(pkg_inst)]
+        except KeyError:
+            arch = pkg_inst.arch
+            children = self._children[id(pkg_inst)] = tuple(
+                (dep, self.match(dep, arch), arch) for dep in reversed(pkg_inst.depends))
+            return children
+
+    def resolve(self, packages):
+        deps = []
+        visited = set()
+        selected = {}
+        stack = [(package, self.match(package), "") for package in reversed(packages)]
+
+        while stack:
+            package, (pkg_inst, preferred), arch = stack.pop()
+
+            if preferred is not None:
+                for c in preferred:
+                    if selected.get(c.key) is c:
+                        pkg_inst = c
+                        break
                 else:
-                    if found:
+                    pkg_inst = next((c for c in preferred if selected.get(c.key, c) is c), None)
+            elif pkg_inst is not None and selected.get(pkg_inst.key, pkg_inst) is not pkg_inst:
+                pkg_inst = None
+
+            if pkg_inst is None:
+                if not self.strict:
+                    continue
+                raise unresolvable(package, self.index, arch)
+
+            if id(pkg_inst) in visited:
+                continue
+
+            visited.add(id(pkg_inst))
+            selected.setdefault(pkg_inst.key, pkg_inst)
+            deps.append(pkg_inst)
+
+            stack.extend(self.children(pkg_inst))
+
+        return deps
+
+
+# Set before forking the batch pool so workers inherit the index copy-on-write
+_batch_state = None
+
+
+def _resolve_batch_chunk(chunk):
+    index, strict = _batch_state
+    resolver = BatchResolver(index, strict)
+
+    # Records are shared with the parent through fork, so their id()s are
+    # the same on both sides and much cheaper to send back than the records
+    return [(n, [id(p) for p in resolver.resolve(packages)]) for n, packages in chunk]
+
+
+def resolve_batch(targets, index, strict=True, workers=None):
+    """Resolve each list of Dependency tuples in targets, returning one closure per target.
+
+    By default everything runs here on one BatchResolver memo. With
+    workers > 1 targets are dealt round robin to a fork()ed process pool
+    instead, never more processes than CPUs, each worker building its own
+    memo for its share; the index is never pickled. Every worker repeats
+    the matching the single memo does only once, so this only pays off
+    for large batches on several otherwise idle cores.
+    """
+    global _batch_state
+
+    workers = min(workers or 1, len(targets), os.cpu_count() or 1)
+    if workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        resolver = BatchResolver(index, strict)
+        return [resolver.resolve(packages) for packages in targets]
+
+    records = {id(p): p for candidates in index.values() for p in candidates}
+    chunks = [list(enumerate(targets))[n::workers] for n in range(workers)]
+    results = [None] * len(targets)
+
+    _batch_state = (index, strict)
+    try:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as executor:
+            for done in executor.map(_resolve_batch_chunk, chunks):
+                for n, ids in done:
+                    results[n] = [records[i] for i in ids]
+    finally:
+        _batch_state = None
+
+    return results
+
+
+def closure_dependency_map(closure, index):
+    """Map each package key in closure to the keys it depends on within it."""
+    selected = {p.key: p for p in closure}
+    dependency_map = {}
+
+    for p in closure:
+        deps = []
+        for group in p.alternatives:
+            # The first alternative the closure actually satisfies
+            for dep in group:
+                pkg_inst = select_candidate(dep, index, selected, p.arch)
+                if pkg_inst is not None and selected.get(pkg_inst.key) is pkg_inst:
+                    deps.append(pkg_inst.key)
+                    break
+        dependency_map[p.key] = deps
+
+    return dependency_map
+
+
+class ClosureQuery(object):
+    """Answer what-depends, why and removal-size questions about one closure.
+
+    Everything is derived once from the closure's dependency map: the
+    reverse edges, a breadth-first tree from the roots for shortest "why"
+    paths and the dominator tree of the graph (Cooper, Harvey and Kennedy's
+    iterative algorithm). A package's dominator subtree is exactly what
+    stops being pulled in once it is gone, so removal sizes are summed up
+    the tree ahead of time and each query is a dict lookup or a short walk.
+    """
+
+    def __init__(self, roots, closure, dependency_map):
+        self.roots = list(dict.fromkeys(r for r in roots if r in dependency_map))
+        self.forward = dependency_map
+        self.sizes = {p.key: p.installed_size for p in closure}
+
+        self.reverse = defaultdict(list)
+        for name, deps in dependency_map.items():
+            for dep in deps:
+                self.reverse[dep].append(name)
+
+        # Multi-source BFS: parent pointers give a shortest path from some root
+        self.parent = dict.fromkeys(self.roots)
+        frontier = list(self.roots)
+        while frontier:
+            following = []
+            for name in frontier:
+                for dep in dependency_map[name]:
+                    if dep not in self.parent:
+                        self.parent[dep] = name
+                        following.append(dep)
+            frontier = following
+
+        self.idom = self._dominators()
+        self.dominated = defaultdict(list)
+
+        self.removal = {name: self.sizes.get(name, 0) for name in self.idom}
+        for name in reversed(self._order):
+            idom = self.idom[name]
+            if idom is not None:
+                self.removal[idom] += self.removal[name]
+                self.dominated[idom].append(name)
+
+    def _dominators(self):
+        # Reverse post-order from a virtual root (None) over the real roots
+        order = []
+        seen = set()
+        for root in self.roots:
+            if root in seen:
+                continue
+            seen.add(root)
+            stack = [(root, iter(self.forward[root]))]
+            while stack:
+                name, children = stack[-1]
+                for child in children:
+                    if child not in seen:
+                        seen.add(child)
+                        stack.append((child, iter(self.forward[child])))
                         break
+                else:
+                    stack.pop()
+                    order.append(name)
+        order.reverse()
+
+        self._order = order
+        position = {name: n + 1 for n, name in enumerate(order)}
+        position[None] = 0
+        roots = set(self.roots)
+        idom = {name: None for name in roots}
+        unset = object()
+
+        def intersect(a, b):
+            while a != b:
+                while position[a] > position[b]:
+                    a = idom[a]
+                while position[b] > position[a]:
+                    b = idom[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for name in order:
+                if name in roots:
                     continue
 
-                if "Depends" in pkg_inst.keys():
-                    # print(pkg_inst["Depends"])
-                    for v in pkg_inst["Depends"]:
-                        build_deps(v["value"], deps, index, dep_stack)
+                new = unset
+                for pred in self.reverse[name]:
+                    if pred in idom:
+                        new = pred if new is unset else intersect(pred, new)
+
+                if idom.get(name, unset) != new:
+                    idom[name] = new
+                    changed = True
+
+        return idom
+
+    def what_depends(self, name):
+        """Names in the closure that depend on name directly."""
+        return list(self.reverse.get(name, ()))
+
+    def why(self, name):
+        """Shortest chain of dependencies from a root to name, None if nothing pulls it in."""
+        if name not in self.parent:
+            return None
+
+        path = []
+        while name is not None:
+            path.append(name)
+            name = self.parent[name]
+
+        return path[::-1]
+
+    def removal_size(self, name):
+        """Return (Installed-Size in KiB, names) freed by dropping name from the closure and the roots."""
+        if name not in self.idom:
+            return (0, [])
+
+        freed = []
+        stack = [name]
+        while stack:
+            name = stack.pop()
+            freed.append(name)
+            stack.extend(self.dominated[name])
+
+        return (self.removal[freed[0]], freed)
+
+
+def archive_url(pkg_inst):
+    # Filename is relative to the archive root, repo_url points at dists/
+    return pkg_inst.repo_url.split("/dists/", 1)[0]
+
+
+def fetch_deb(pkg_inst, download_dir, cache=None):
+    """Download the .deb of pkg_inst into download_dir and check its SHA256.
+
+    With an ArtifactCache the cached copy is returned when there is one,
+    and a fresh download is moved into the cache.
+    """
+    if cache is not None and pkg_inst.sha256:
+        cached = cache.get_deb(pkg_inst.sha256)
+        if cached:
+            metrics.count("artifact_cache_hits")
+            return cached
+
+    filename = os.path.join(download_dir, os.path.basename(pkg_inst.filename))
+
+    if not (os.path.exists(filename) and (not pkg_inst.sha256 or file_digest(filename) == pkg_inst.sha256)):
+        fetch_url(f"{archive_url(pkg_inst)}/{pkg_inst.filename}", filename, conditional=False)
+
+        if pkg_inst.sha256 and file_digest(filename) != pkg_inst.sha256:
+            os.remove(filename)
+            raise ValueError(f"SHA256 mismatch for {pkg_inst.name} {pkg_inst.version} ({pkg_inst.filename})")
+
+    if cache is not None and pkg_inst.sha256:
+        return cache.add_deb(pkg_inst.sha256, filename)
+
+    return filename
+
+
+class _MemberReader(object):
+    # Bounded read() view of one ar member so tarfile can stream it
+    def __init__(self, f, size):
+        self._f = f
+        self._left = size
+
+    def read(self, n=-1):
+        if n < 0 or n > self._left:
+            n = self._left
+        data = self._f.read(n)
+        self._left -= len(data)
+        return data
+
+
+def extract_deb(filename, root):
+    """Extract the data members of a .deb into root, like dpkg-deb -x.
 
-            if found:
+    The ar container is walked in pure Python and data.tar streamed through
+    tarfile; compressions tarfile cannot read (zstd) are decompressed by
+    dpkg-deb --fsys-tarfile. Returns the paths written, relative to root.
+    """
+    with open(filename, "rb") as f:
+        if f.read(8) != b"!<arch>\n":
+            raise ValueError(f"{filename} is not a Debian archive")
+
+        while True:
+            header = f.read(60)
+            if len(header) < 60:
+                raise ValueError(f"No data member in {filename}")
+
+            name = header[:16].decode().strip().rstrip("/")
+            size = int(header[48:58].decode().strip())
+
+            if name.startswith("data.tar"):
                 break
-    else:
-        raise ValueError(f"Package not found {package['name']}")
 
-    if len(dep_stack) > 0:
-        dep_stack.pop()
+            f.seek(size + size % 2, os.SEEK_CUR)
+
+        modes = {"data.tar": "r|", "data.tar.gz": "r|gz", "data.tar.xz": "r|xz", "data.tar.bz2": "r|bz2"}
+        if name in modes:
+            with tarfile.open(fileobj=_MemberReader(f, size), mode=modes[name]) as tar:
+                return _extract(tar, root)
+
+    with subprocess.Popen(["dpkg-deb", "--fsys-tarfile", filename], stdout=subprocess.PIPE) as proc:
+        with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+            written = _extract(tar, root)
+
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    return written
+
+
+def _extract(tar, root):
+    # Package contents are trusted once the SHA256 matched the index;
+    # keep setuid bits and absolute symlinks as dpkg would
+    extract_args = {"filter": "fully_trusted"} if hasattr(tarfile, "fully_trusted_filter") else {}
+    written = []
+
+    tar.extractall(root, members=_replacing(tar, root, written), **extract_args)
+    return written
+
+
+def _replacing(tar, root, written):
+    # Remove whatever non-directory a member will overwrite before tarfile
+    # writes it, as dpkg renames new files into place. Roots populated from
+    # an ArtifactCache with link_mode="hardlink" share inodes with it, and
+    # writing through such a link would change the shared copy.
+    for member in tar:
+        if not member.isdir():
+            target = os.path.join(root, member.name)
+            if os.path.lexists(target) and not os.path.isdir(target):
+                os.remove(target)
+
+        name = os.path.normpath(member.name)
+        if name != ".":
+            written.append(name)
+
+        yield member
+
+
+def install_plan(dependency_map, installed=(), layered=False):
+    """Return (segments, waiting) for unpacking what is not installed yet.
+
+    segments lists the packages to unpack in install order: one segment
+    per topological layer when layered (extraction then waits for each
+    segment to finish, to snapshot it), otherwise a single one. waiting
+    maps each of them to the packages it must wait for, which leaves out
+    those installed and the members of its own dependency cycle.
+    """
+    sorter = load_script("deb-topological").TopologicalSort(dependency_map)
+    component_of = {member: n for n, component in enumerate(sorter.components()) for member in component}
+
+    waiting = {
+        name: {d for d in deps if component_of[d] != component_of[name] and d not in installed}
+        for name, deps in dependency_map.items() if name not in installed
+    }
+
+    segments = [[name for name in layer if name not in installed] for layer in sorter.layers()]
+    segments = [segment for segment in segments if segment]
+    if not layered:
+        segments = [[name for segment in segments for name in segment]]
+
+    return (segments, waiting)
+
+
+def build_rootfs(closure, index, root, download_dir="debs", jobs=8, workers=None, cache=None, dependency_map=None,
+                 snapshots=None):
+    """Download, verify and extract closure into root, layer by layer from the best snapshot when given one.
+
+    Returns the .deb path of each package of closure, None for those from a snapshot.
+    """
+    if dependency_map is None:
+        dependency_map = closure_dependency_map(closure, index)
+
+    os.makedirs(download_dir, exist_ok=True)
+    os.makedirs(root, exist_ok=True)
+
+    debstores = load_script("deb-stores")
+    records = {p.key: p for p in closure}
+    stores = (cache, snapshots)
+    paths = {}
+    with contextlib.ExitStack() as stack:
+        for store in stores:
+            if store is not None:
+                stack.enter_context(store.use())
+
+        snapshots, installed = debstores.start_from_snapshot(closure, root, snapshots)
+        segments, waiting = install_plan(dependency_map, installed, snapshots is not None)
+
+        dependents = defaultdict(set)
+        for name, deps in waiting.items():
+            for d in deps:
+                dependents[d].add(name)
+
+        segment_of = {name: n for n, segment in enumerate(segments) for name in segment}
+        current = 0
+        left = len(segments[0]) if segments else 0
+        held = []
+        written = []
+
+        fetch_pool = stack.enter_context(ThreadPoolExecutor(max_workers=max(1, jobs)))
+        unpack_pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+
+        futures = {
+            fetch_pool.submit(fetch_deb, records[name], download_dir, cache): ("fetch", name)
+            for segment in segments for name in segment
+        }
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                stage, name = futures.pop(future)
+                result = future.result()
+                ready = []
+
+                if stage == "fetch":
+                    paths[name] = result
+                    if not waiting[name]:
+                        ready.append(name)
+                else:
+                    installed.add(name)
+                    if snapshots is not None:
+                        written += result
+                    for dependent in dependents[name]:
+                        waiting[dependent].discard(name)
+                        if not waiting[dependent] and dependent in paths:
+                            ready.append(dependent)
+
+                    left -= 1
+                    if left == 0 and snapshots is not None:
+                        with metrics.span("snapshot_record"):
+                            snapshots.record([records[n] for n in installed], [records[n] for n in segments[current]],
+                                             root, written)
+                        written = []
+
+                        current += 1
+                        left = len(segments[current]) if current < len(segments) else 0
+                        ready += [r for r in held if segment_of[r] == current]
+                        held = [r for r in held if segment_of[r] != current]
+
+                for r in ready:
+                    if segment_of[r] > current:
+                        held.append(r)
+                        continue
+                    futures[unpack_pool.submit(debstores.unpack_deb, paths[r], root, records[r].sha256, cache)] = ("extract", r)
+
+    for store in stores:
+        if store is not None:
+            store.evict()
+
+    return [paths.get(p.key) for p in closure]
+
+
+LOCK_VERSION = 1
+
+
+def lock_key(packages, files, alternatives=False, pins=None):
+    """Hash of the requested packages and the digests of the indices they resolve against."""
+    key = hashlib.sha256(str(LOCK_VERSION).encode())
+    key.update(json.dumps([list(p) for p in packages]).encode())
+    if pins:
+        key.update(repr(sorted(pins.items())).encode())
+    if alternatives:
+        key.update(b"alternatives\n")
+    for url, filename in files:
+        key.update(f"{url} {file_digest(filename)}\n".encode())
+
+    return key.hexdigest()
+
+
+def lock_data(key, packages, closure, index):
+    dependency_map = closure_dependency_map(closure, index)
+
+    return {
+        "version": LOCK_VERSION,
+        "key": key,
+        "packages": [p._asdict() for p in packages],
+        "closure": [
+            {
+                "Package": p.name,
+                "Version": p.version,
+                "Architecture": p.arch,
+                "Filename": p.filename,
+                "SHA256": p.sha256,
+                "Installed-Size": p.installed_size,
+                "repo_url": p.repo_url,
+                "Depends": dependency_map[p.key],
+                **({"Key": p.key} if p.key != p.name else {})
+            }
+            for p in closure
+        ],
+        "layers": load_script("deb-topological").TopologicalSort(dependency_map).layers()
+    }
+
+
+def write_lock(filename, key, packages, closure, index):
+    lock = lock_data(key, packages, closure, index)
+
+    atomic_write(filename, lambda f: f.write(json.dumps(lock, indent=4).encode()))
+
+
+def read_lock(filename):
+    """Return the lock in filename, or None if it is missing or of another LOCK_VERSION."""
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename, "r") as f:
+        lock = json.load(f)
+
+    return lock if lock.get("version") == LOCK_VERSION else None
+
+
+def closure_from_lock(lock):
+    """Rebuild (closure, dependency_map) from a lock without any index."""
+    closure = []
+    for p in lock["closure"]:
+        pkg_inst = PackageRecord(
+            p["Package"], p["Version"], arch=p["Architecture"], filename=p["Filename"],
+            sha256=p["SHA256"], repo_url=p["repo_url"], installed_size=p.get("Installed-Size", 0)
+        )
+        pkg_inst.key = p.get("Key", pkg_inst.name)
+        closure.append(pkg_inst)
+
+    return (closure, {p.get("Key", p["Package"]): p["Depends"] for p in lock["closure"]})
+
+
+def verify_lock(lock, index):
+    """Check every locked package against index without resolving anything.
+
+    Returns (missing, upgradable): locked packages whose exact Version and
+    SHA256 are gone from index, and those for which index now has a newer
+    version.
+    """
+    missing = []
+    upgradable = []
+
+    for p in lock["closure"]:
+        candidates = [c for c in index.get(p["Package"], [])
+                      if c.name == p["Package"] and c.arch == p["Architecture"]]
+
+        if not any(c.version == p["Version"] and c.sha256 == p["SHA256"] for c in candidates):
+            missing.append(p["Package"])
+        elif candidates and version_compare(candidates[0].version, p["Version"]) > 0:
+            upgradable.append(p["Package"])
+
+    return (missing, upgradable)
 
-    return
 
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file
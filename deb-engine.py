@@ -0,0 +1,228 @@
+import os
+import urllib.error
+import urllib.parse
+import random
+import asyncio
+import logging
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from siblings import load_script
+
+
+debdeps = load_script("deb-deps")
+debstores = load_script("deb-stores")
+
+
+def retryable(e):
+    """Whether a failed request looks transient: connection trouble, 5xx or 429."""
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code >= 500 or e.code == 429
+
+    return isinstance(e, (urllib.error.URLError, ConnectionError, TimeoutError))
+
+
+class BootstrapEngine(object):
+    """Fetch, resolve and build several roots concurrently in one event loop.
+
+    Requests hold one of per_host slots and transient failures are retried
+    with backoff; at most window packages are downloaded but not extracted.
+    """
+
+    def __init__(self, user_config, download_dir="debs", index_dir=".", cache_dir="index-cache",
+                 jobs=16, workers=None, per_host=4, retries=3, backoff=0.5, window=64,
+                 offline=False, compression="smallest", alternatives=False, cache=None, snapshots=None):
+        self.user_config = user_config
+        self.download_dir = download_dir
+        self.index_dir = index_dir
+        self.cache_dir = cache_dir
+        self.jobs = jobs
+        self.workers = workers
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.offline = offline
+        self.compression = compression
+        self.alternatives = alternatives
+        self.cache = cache
+        self.snapshots = snapshots
+        self._window_size = window
+        self._hosts = {}
+        self._index = None
+
+    async def __aenter__(self):
+        self._stack = contextlib.ExitStack()
+        self._io = self._stack.enter_context(ThreadPoolExecutor(max_workers=max(1, self.jobs)))
+        self._unpack = self._stack.enter_context(ProcessPoolExecutor(max_workers=self.workers))
+        self._window = asyncio.Semaphore(self._window_size)
+
+        for store in (self.cache, self.snapshots):
+            if store is not None:
+                self._stack.enter_context(store.use())
+
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.to_thread(self._stack.close)
+
+        for store in (self.cache, self.snapshots):
+            if store is not None:
+                await asyncio.to_thread(store.evict)
+
+    async def request(self, url, func, *args):
+        """Run the blocking func(*args), which talks to the host of url, in one of its slots."""
+        loop = asyncio.get_running_loop()
+        host = urllib.parse.urlsplit(url).netloc
+        slots = self._hosts.setdefault(host, asyncio.Semaphore(self.per_host))
+        attempt = 0
+
+        while True:
+            async with slots:
+                try:
+                    return await loop.run_in_executor(self._io, func, *args)
+                except Exception as e:
+                    if attempt >= self.retries or not retryable(e):
+                        raise
+                    error = e
+
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            attempt += 1
+            debdeps.metrics.count("retries")
+            logging.warning(f"{url}: {error}, retry {attempt} of {self.retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def fetch_indices(self):
+        """Bring every Packages index up to date like fetch_repo_files, return [(url, filename), ...]."""
+        with debdeps.metrics.span("fetch"):
+            os.makedirs(self.index_dir, exist_ok=True)
+
+            dists = {}
+            for repo, _, dist, _, _, _ in debdeps.repo_targets(self.user_config):
+                dists.setdefault((repo["repo_url"], dist), repo)
+
+            releases = await asyncio.gather(*(
+                self.request(repo_url, debdeps.fetch_release, repo, dist, self.index_dir, self.offline)
+                for (repo_url, dist), repo in dists.items()
+            ))
+            targets = debdeps.index_targets(self.user_config, self.index_dir, dict(zip(dists, releases)))
+
+            pending = {}
+            for target in targets:
+                pending.setdefault(target[1], target)
+
+            synced = await asyncio.gather(*(
+                self.request(target[0], debdeps.sync_index, *target, self.index_dir, self.offline, self.compression)
+                for target in pending.values()
+            ))
+            synced = dict(zip(pending, synced))
+
+        return [(target[0], synced[target[1]]) for target in targets]
+
+    async def load_index(self):
+        """Return the package index, fetching and loading it on first use only."""
+        if self._index is None:
+            self._index = asyncio.ensure_future(self._load_index())
+
+        return await self._index
+
+    async def _load_index(self):
+        files = await self.fetch_indices()
+        loaded = await asyncio.to_thread(debdeps.load_repo_index, self.user_config, self.cache_dir, files)
+
+        return loaded[2]
+
+    async def resolve(self, packages):
+        """Return (closure, dependency_map) of packages, a list of Dependency tuples."""
+        index = await self.load_index()
+        resolver = debdeps.resolve_alternatives if self.alternatives else debdeps.resolve
+
+        with debdeps.metrics.span("resolve"):
+            closure = await asyncio.to_thread(resolver, packages, index)
+            dependency_map = await asyncio.to_thread(debdeps.closure_dependency_map, closure, index)
+
+        return (closure, dependency_map)
+
+    async def build(self, closure, dependency_map, root):
+        """Fetch and extract closure into root like build_rootfs, snapshots included."""
+        loop = asyncio.get_running_loop()
+        records = {p.key: p for p in closure}
+
+        os.makedirs(self.download_dir, exist_ok=True)
+        os.makedirs(root, exist_ok=True)
+
+        snapshots, installed = await asyncio.to_thread(debstores.start_from_snapshot, closure, root, self.snapshots)
+        segments, waiting = debdeps.install_plan(dependency_map, installed, snapshots is not None)
+
+        extracted = {name: asyncio.Event() for name in waiting}
+        segment_done = [asyncio.Event() for _ in segments]
+        left = [len(segment) for segment in segments]
+        written = [[] for _ in segments]
+        paths = {}
+
+        async def install(name, n):
+            pkg_inst = records[name]
+            try:
+                paths[name] = await self.request(
+                    f"{debdeps.archive_url(pkg_inst)}/{pkg_inst.filename}", debdeps.fetch_deb, pkg_inst, self.download_dir, self.cache)
+
+                for dep in waiting[name]:
+                    await extracted[dep].wait()
+                if n:
+                    await segment_done[n - 1].wait()
+
+                written[n] += await loop.run_in_executor(
+                    self._unpack, debstores.unpack_deb, paths[name], root, pkg_inst.sha256, self.cache)
+            finally:
+                self._window.release()
+
+            installed.add(name)
+            extracted[name].set()
+
+            left[n] -= 1
+            if left[n] == 0:
+                if snapshots is not None:
+                    with debdeps.metrics.span("snapshot_record"):
+                        await asyncio.to_thread(snapshots.record, [records[m] for m in installed],
+                                                [records[m] for m in segments[n]], root, written[n])
+                written[n] = []
+                segment_done[n].set()
+
+        tasks = []
+        try:
+            # Slots are taken in install order, so the oldest pending package
+            # of every root has all it waits for extracted: no deadlock
+            for n, segment in enumerate(segments):
+                for name in segment:
+                    await self._window.acquire()
+                    tasks.append(asyncio.ensure_future(install(name, n)))
+
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        return [paths.get(p.key) for p in closure]
+
+    async def bootstrap(self, packages, root=None):
+        """Resolve packages and, given a root, build it. Returns the closure."""
+        closure, dependency_map = await self.resolve(packages)
+
+        if root is not None:
+            with debdeps.metrics.span("rootfs"):
+                await self.build(closure, dependency_map, root)
+
+        return closure
+
+
+def bootstrap(user_config, targets, **options):
+    """Resolve and build every (packages, root) of targets concurrently.
+
+    packages is a list of Dependency tuples and root may be None to only
+    resolve. options go to BootstrapEngine. Returns the closures in the
+    order of targets.
+    """
+    async def run():
+        async with BootstrapEngine(user_config, **options) as engine:
+            return await asyncio.gather(*(engine.bootstrap(packages, root) for packages, root in targets))
+
+    return asyncio.run(run())
@@ -0,0 +1,129 @@
+import os
+import json
+import socket
+import socketserver
+import threading
+import hashlib
+import logging
+
+from siblings import load_script
+
+
+debdeps = load_script("deb-deps")
+
+
+def index_key(files):
+    return hashlib.sha256("".join(f"{url} {debdeps.file_digest(filename)}\n" for url, filename in files).encode()).hexdigest()
+
+
+class ResolveHandler(socketserver.StreamRequestHandler):
+    """One JSON request per line in, one JSON response per line out.
+
+    {"packages": [{"name": ..., "version": ..., "version_test": ...}, ...],
+    "alternatives": false} is answered with the same layout as a --lock file,
+    {"op": "status"} with the key of the loaded indices. Failures come back
+    as {"error": ...}.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+
+            try:
+                response = self.server.dispatch(json.loads(line))
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+
+            self.wfile.write((json.dumps(response) + "\n").encode())
+            self.wfile.flush()
+
+
+class ResolverServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Keep one loaded index hot and resolve against it over a Unix socket.
+
+    Each connection gets its own thread, so concurrent requests do not
+    queue behind each other. A background thread re-runs fetch_repo_files
+    every reload_interval seconds and, when the index digests change,
+    loads the new index (through the usual cache) and swaps it in; requests
+    in flight keep the index they started with. A request's "alternatives"
+    flag picks resolve_alternatives over resolve; requests without one get
+    the server's alternatives default.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, config, load_args, fetch_args, reload_interval=300, alternatives=False):
+        self._config = config
+        self._alternatives = alternatives
+        self._load_args = load_args
+        self._fetch_args = fetch_args
+        self._reload_interval = reload_interval
+        self._stop = threading.Event()
+        self.state = (None, None)
+
+        self.load()
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, ResolveHandler)
+
+    def load(self):
+        files = debdeps.fetch_repo_files(self._config, **self._fetch_args)
+        key = index_key(files)
+
+        if key != self.state[0]:
+            bindex = debdeps.load_repo_index(self._config, files=files, **self._load_args)[2]
+            self.state = (key, bindex)
+            logging.info(f"Loaded index {key}")
+
+    def _reloader(self):
+        while not self._stop.wait(self._reload_interval):
+            try:
+                self.load()
+            except Exception as e:
+                logging.warning(f"Index reload failed, keeping the current one: {e}")
+
+    def dispatch(self, request):
+        key, bindex = self.state
+
+        if request.get("op", "resolve") == "status":
+            return {"key": key, "metrics": debdeps.metrics.snapshot()} if debdeps.metrics.enabled else {"key": key}
+
+        packages = [debdeps.package_dependency(p) for p in request["packages"]]
+        resolver = debdeps.resolve_alternatives if request.get("alternatives", self._alternatives) else debdeps.resolve
+
+        with debdeps.metrics.span("resolve"):
+            closure = resolver(packages, bindex)
+        debdeps.metrics.count("requests")
+
+        return debdeps.lock_data(key, packages, closure, bindex)
+
+    def serve(self):
+        threading.Thread(target=self._reloader, daemon=True).start()
+        try:
+            self.serve_forever()
+        finally:
+            self._stop.set()
+            self.server_close()
+            os.remove(self.server_address)
+
+
+def request_resolve(socket_path, packages, alternatives=False):
+    """Resolve packages (Dependency tuples) through a ResolverServer and return its response.
+
+    alternatives asks the server for resolve_alternatives instead of resolve.
+    """
+    request = {"packages": [p._asdict() for p in packages], "alternatives": alternatives}
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall((json.dumps(request) + "\n").encode())
+
+        with s.makefile("rb") as f:
+            response = json.loads(f.readline())
+
+    if "error" in response:
+        raise ValueError(response["error"])
+
+    return response
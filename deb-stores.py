@@ -0,0 +1,409 @@
+import os
+import json
+import shutil
+import contextlib
+import fcntl
+import errno
+import stat
+import tempfile
+import hashlib
+import logging
+
+from siblings import load_script
+
+
+debdeps = load_script("deb-deps")
+
+
+class LRUStore(object):
+    """Entries under objects/, evicted least recently used first unless a build in use() references them."""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._refs = None
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(path, "builders"), exist_ok=True)
+
+    def __getstate__(self):
+        # Worker processes only use entries their parent already references
+        state = self.__dict__.copy()
+        state["_refs"] = None
+        return state
+
+    def _entry(self, key):
+        return os.path.join(self.path, "objects", key)
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=False):
+        # Held shared while references are added, exclusively while evicting
+        with open(os.path.join(self.path, "lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def use(self):
+        """Hold the store for a build, keeping what it references from eviction until it ends.
+
+        The build's references go to a file under builders/ that it keeps
+        flocked: one evict() can lock is left over from a build that died.
+        """
+        with self.lock():
+            fd, filename = tempfile.mkstemp(dir=os.path.join(self.path, "builders"))
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+        self._refs = fd
+        try:
+            yield
+        finally:
+            self._refs = None
+            os.remove(filename)
+            os.close(fd)
+
+    def reference(self, keys):
+        """Keep the entries of keys, published or not yet, until the current use() ends."""
+        if self._refs is not None:
+            with self.lock():
+                os.write(self._refs, "".join(f"{key}\n" for key in keys).encode())
+
+    def _referenced(self):
+        refs = set()
+        builders = os.path.join(self.path, "builders")
+
+        for name in os.listdir(builders):
+            filename = os.path.join(builders, name)
+            with open(filename) as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    refs.update(f.read().split())
+                else:
+                    os.remove(filename)
+
+        return refs
+
+    def _touch(self, entry):
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            pass
+
+    def _publish(self, tmp, entry):
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Someone else published the same content first
+            if not os.path.isdir(entry):
+                raise
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def evict(self):
+        """Drop least recently used entries no build references until the store fits max_bytes."""
+        with self.lock(exclusive=True):
+            refs = self._referenced()
+            objects = os.path.join(self.path, "objects")
+            entries = []
+            total = 0
+            for name in os.listdir(objects):
+                entry = os.path.join(objects, name)
+                if name.startswith(".") or not os.path.isdir(entry):
+                    continue
+                try:
+                    with open(os.path.join(entry, "size")) as f:
+                        size = int(f.read())
+                except (OSError, ValueError):
+                    size = tree_size(entry)
+                total += size
+                if name not in refs:
+                    entries.append((os.stat(entry).st_mtime, size, entry))
+
+            for _, size, entry in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+
+
+class ArtifactCache(LRUStore):
+    """objects/<sha256>/ holds a .deb ("deb"), its extracted tree ("tree/") and their size ("size").
+
+    Roots get clones of the tree, or hardlinks sharing the cached inodes with link_mode="hardlink".
+    """
+
+    def __init__(self, path, max_bytes=10 << 30, link_mode="reflink"):
+        super().__init__(path, max_bytes)
+        self.link_mode = link_mode
+
+    def get_deb(self, sha256):
+        self.reference([sha256])
+        deb = os.path.join(self._entry(sha256), "deb")
+        if not os.path.exists(deb):
+            return None
+
+        self._touch(self._entry(sha256))
+        return deb
+
+    def add_deb(self, sha256, filename):
+        """Move the downloaded .deb filename into the cache and return its cached path.
+
+        filename and its .meta sidecar are gone afterwards: renamed into the
+        entry on the same filesystem, copied and removed across filesystems,
+        or just removed when another process cached the digest first.
+        """
+        self.reference([sha256])
+        entry = self._entry(sha256)
+        if not os.path.exists(os.path.join(entry, "deb")):
+            tmp = tempfile.mkdtemp(prefix=f".{sha256}.", dir=os.path.join(self.path, "objects"))
+            size = os.path.getsize(filename)
+            try:
+                os.replace(filename, os.path.join(tmp, "deb"))
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.copy2(filename, os.path.join(tmp, "deb"))
+            with open(os.path.join(tmp, "size"), "w") as f:
+                f.write(str(size))
+            self._publish(tmp, entry)
+
+        for leftover in (filename, f"{filename}.meta"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+        self._touch(entry)
+        return os.path.join(entry, "deb")
+
+    def ensure_tree(self, sha256, filename):
+        """Return the extracted tree of the .deb with this digest, extracting it once."""
+        entry = self._entry(sha256)
+        tree = os.path.join(entry, "tree")
+
+        if not os.path.isdir(tree):
+            tmp = tempfile.mkdtemp(prefix=f".{sha256}.tree.", dir=entry)
+            debdeps.extract_deb(filename, tmp)
+            try:
+                os.rename(tmp, tree)
+            except OSError:
+                if not os.path.isdir(tree):
+                    raise
+                shutil.rmtree(tmp, ignore_errors=True)
+            else:
+                size = os.path.getsize(os.path.join(entry, "deb")) + tree_size(tree)
+                debdeps.atomic_write(os.path.join(entry, "size"), lambda f: f.write(str(size).encode()))
+
+        self._touch(entry)
+        return tree
+
+    def link_tree(self, tree, root):
+        return populate_tree(tree, root, self.link_mode)
+
+
+class SnapshotStore(LRUStore):
+    """One entry per install layer: the files it wrote ("tree/") on top of its "parent" entry.
+
+    Keys hash the packages of the prefix so far, so builds reaching the same set share an entry.
+    """
+
+    def __init__(self, path, max_bytes=20 << 30):
+        super().__init__(path, max_bytes)
+
+    @staticmethod
+    def _ident(pkg_inst):
+        return (pkg_inst.name, pkg_inst.version, pkg_inst.arch, pkg_inst.sha256)
+
+    def key(self, records):
+        h = hashlib.sha256()
+        for ident in sorted(map(self._ident, records)):
+            h.update((" ".join(ident) + "\n").encode())
+
+        return h.hexdigest()
+
+    def _chain(self, key):
+        # Keys of the layers from the first up to key, None if one is gone
+        chain = []
+        while key:
+            try:
+                with open(os.path.join(self._entry(key), "parent")) as f:
+                    parent = f.read()
+            except OSError:
+                return None
+
+            chain.append(key)
+            key = parent
+
+        return chain[::-1]
+
+    def _hold(self, key):
+        # Reference every layer up to key; an eviction may have won the race
+        chain = self._chain(key)
+        if chain is not None:
+            self.reference(chain)
+            chain = self._chain(key)
+
+        if chain is not None:
+            # Newest at the bottom, so eviction drops the top layers first
+            for layer in reversed(chain):
+                self._touch(self._entry(layer))
+
+        return chain
+
+    def find(self, closure):
+        """Return (key, keys) of the largest snapshot within closure, None if there is none."""
+        wanted = set(map(self._ident, closure))
+        objects = os.path.join(self.path, "objects")
+        found = []
+
+        for name in os.listdir(objects):
+            if name.startswith("."):
+                continue
+
+            try:
+                with open(os.path.join(objects, name, "packages")) as f:
+                    packages = [tuple(p) for p in json.load(f)]
+            except (OSError, ValueError):
+                continue
+
+            if wanted.issuperset(packages):
+                found.append((len(packages), name, packages))
+
+        for _, name, packages in sorted(found, reverse=True):
+            if self._hold(name) is not None:
+                packages = set(packages)
+                return (name, {p.key for p in closure if self._ident(p) in packages})
+
+        return None
+
+    def clone(self, key, root):
+        for layer in self._chain(key):
+            populate_tree(os.path.join(self._entry(layer), "tree"), root)
+
+    def record(self, records, layer, root, paths):
+        """Snapshot root, which holds exactly records, unless that set already has one.
+
+        layer are the records unpacked last and paths what they wrote into
+        root: only those are copied, on top of the entry of the records
+        below them. If that is gone, the whole root is copied instead.
+        """
+        key = self.key(records)
+        entry = self._entry(key)
+        self.reference([key])
+
+        if not os.path.isdir(entry):
+            unpacked = {p.key for p in layer}
+            below = [p for p in records if p.key not in unpacked]
+            parent = self.key(below) if below else ""
+            if parent and self._hold(parent) is None:
+                parent, layer, paths = "", records, None
+
+            tmp = tempfile.mkdtemp(prefix=".snapshot.", dir=os.path.join(self.path, "objects"))
+            populate_tree(root, os.path.join(tmp, "tree"), paths=None if paths is None else sorted(set(paths)))
+
+            packages = sorted(map(self._ident, records))
+            debdeps.atomic_write(os.path.join(tmp, "packages"), lambda f: f.write(json.dumps(packages).encode()))
+            with open(os.path.join(tmp, "parent"), "w") as f:
+                f.write(parent)
+            with open(os.path.join(tmp, "size"), "w") as f:
+                f.write(str(sum(p.installed_size for p in layer) << 10))
+
+            self._publish(tmp, entry)
+
+        self._hold(key)
+
+
+def tree_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            total += os.lstat(os.path.join(dirpath, name)).st_size
+
+    return total
+
+
+FICLONE = 0x40049409
+
+
+def _clone_file(src, dst):
+    # Copy-on-write clone where the filesystem supports it, plain copy otherwise
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copyfileobj(fsrc, fdst, 1 << 20)
+    shutil.copystat(src, dst)
+
+
+def populate_tree(tree, root, link_mode="reflink", paths=None):
+    """Recreate tree, or just paths relative to it, under root, linking or cloning files instead of copying them.
+
+    Returns the paths populated.
+    """
+    if paths is None:
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(tree):
+            rel = os.path.relpath(dirpath, tree)
+            paths += [os.path.normpath(os.path.join(rel, name)) for name in dirnames + filenames]
+
+            # Don't descend into symlinked directories
+            dirnames[:] = [d for d in dirnames if not os.path.islink(os.path.join(dirpath, d))]
+
+    for rel in paths:
+        src = os.path.join(tree, rel)
+        dst = os.path.join(root, rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+        if os.path.islink(src):
+            if os.path.lexists(dst):
+                os.remove(dst)
+            os.symlink(os.readlink(src), dst)
+        elif os.path.isdir(src):
+            os.makedirs(dst, exist_ok=True)
+            os.chmod(dst, stat.S_IMODE(os.lstat(src).st_mode))
+        else:
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if link_mode == "hardlink":
+                try:
+                    os.link(src, dst)
+                    continue
+                except OSError:
+                    pass
+            _clone_file(src, dst)
+
+    return paths
+
+
+def unpack_deb(filename, root, sha256=None, cache=None):
+    """Extract the .deb filename into root, through cache when given one. Returns the paths written."""
+    if cache is None or not sha256:
+        return debdeps.extract_deb(filename, root)
+
+    return cache.link_tree(cache.ensure_tree(sha256, filename), root)
+
+
+def start_from_snapshot(closure, root, snapshots):
+    """Clone the largest snapshot within closure into root.
+
+    Returns (snapshots, keys of the packages now in root). Whatever is
+    already in a non-empty root is unknown, so it can neither be matched
+    against nor snapshotted: snapshots comes back as None then.
+    """
+    if snapshots is None:
+        return (None, set())
+
+    if os.listdir(root):
+        logging.warning(f"{root} is not empty, building without snapshots")
+        return (None, set())
+
+    found = snapshots.find(closure)
+    if found is None:
+        return (snapshots, set())
+
+    with debdeps.metrics.span("snapshot_clone"):
+        snapshots.clone(found[0], root)
+    debdeps.metrics.count("snapshot_hits")
+    debdeps.metrics.count("snapshot_packages_reused", len(found[1]))
+    logging.info(f"Starting {root} from a snapshot of {len(found[1])} of {len(closure)} packages")
+
+    return (snapshots, set(found[1]))
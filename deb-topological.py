@@ -6,19 +6,15 @@ import subprocess
 import logging
 import json
 import argparse
-import wget
-import gzip
 import uuid
+import cProfile
 
 import sys
 
-rootLogger = logging.getLogger()
-rootLogger.setLevel(logging.INFO)
-consoleHandler = logging.StreamHandler(sys.stdout)
-consoleHandler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-rootLogger.addHandler(consoleHandler)
+from siblings import load_script
 
-SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+debdeps = load_script("deb-deps")
 
 
 def callProcess(cmd, live_output=False, printcmd=False, curdir="/", valid_returncodes=[0,], root=False, inc_returncode=False):
@@ -66,136 +62,219 @@ def callProcess(cmd, live_output=False, printcmd=False, curdir="/", valid_return
 
 
 class TopologicalSort(object):
-    def __init__(self, dependency_map):
-        self._dependency_map = dependency_map
-        self._already_processed = set()
-
-    def _get_dependencies(self, item, root=None):
-        print("Item: %s" % item)
-
-        if not root:
-            root = item
-            print("Root: %s" % root)
+    """Order packages so every package comes after its dependencies.
 
-        elif root == item:
-            logging.warn("circular dependency detected in '{}'".format(item))
-            yield item
-            #raise StopIteration()
+    dependency_map maps a package id to the ids it depends on; ids that are
+    only referenced and never declared are ignored. Dependency cycles, which
+    Debian has for real (libc6/libgcc1, perl-base/perl, ...), are first
+    collapsed into strongly connected components with Tarjan's algorithm.
+    Kahn's algorithm over those components then yields layers: no package
+    in a layer depends on a package in the same or a later layer, except on
+    members of its own cycle, so each layer can be unpacked concurrently.
+    """
 
-        dependencies = self._dependency_map.get(item, [])
-        print(dependencies)
-        for dependency in dependencies:
-
-            if dependency in self._already_processed:
+    def __init__(self, dependency_map):
+        self._dependency_map = dependency_map
+        self._components = None
+        self.cycles = []
+
+    def _edges(self, item):
+        return [d for d in self._dependency_map.get(item, []) if d in self._dependency_map and d != item]
+
+    def components(self):
+        """Tarjan's SCC algorithm, iterative so deep graphs cannot hit the recursion limit."""
+        if self._components is not None:
+            return self._components
+
+        index = {}
+        lowlink = {}
+        on_stack = set()
+        stack = []
+        components = []
+        counter = 0
+
+        for root in sorted(self._dependency_map):
+            if root in index:
                 continue
 
-            self._already_processed.add(dependency)
-
-            for sub_dependency in self._get_dependencies(dependency, root=root):
-                yield sub_dependency
+            work = [(root, iter(self._edges(root)))]
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack.add(root)
+
+            while work:
+                node, edges = work[-1]
+                advanced = False
+
+                for dep in edges:
+                    if dep not in index:
+                        index[dep] = lowlink[dep] = counter
+                        counter += 1
+                        stack.append(dep)
+                        on_stack.add(dep)
+                        work.append((dep, iter(self._edges(dep))))
+                        advanced = True
+                        break
+                    elif dep in on_stack:
+                        lowlink[node] = min(lowlink[node], index[dep])
+
+                if advanced:
+                    continue
 
-            yield dependency
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(sorted(component))
+
+        self.cycles = [c for c in components if len(c) > 1]
+        for cycle in self.cycles:
+            logging.info("dependency cycle: {}".format(" ".join(cycle)))
+
+        self._components = components
+        return components
+
+    def layers(self):
+        with debdeps.metrics.span("sort"):
+            return self._layers()
+
+    def _layers(self):
+        components = self.components()
+        component_of = {member: n for n, component in enumerate(components) for member in component}
+
+        remaining = [0] * len(components)
+        dependents = [set() for _ in components]
+
+        for n, component in enumerate(components):
+            deps = {component_of[d] for member in component for d in self._edges(member)} - {n}
+            remaining[n] = len(deps)
+            for d in deps:
+                dependents[d].add(n)
+
+        layers = []
+        ready = [n for n, count in enumerate(remaining) if count == 0]
+
+        while ready:
+            layers.append(sorted(member for n in ready for member in components[n]))
+
+            next_ready = []
+            for n in ready:
+                for dependent in dependents[n]:
+                    remaining[dependent] -= 1
+                    if remaining[dependent] == 0:
+                        next_ready.append(dependent)
+            ready = next_ready
+
+        return layers
 
     def sort(self):
-        print("sort")
-        # Reduction, connect all nodes to a dummy node and re-calculate
-        special_package_id = 'topological-sort-special-node'
-        self._dependency_map[special_package_id] = self._dependency_map.keys()
-        sorted_dependencies = self._get_dependencies(special_package_id)
-        sorted_dependencies = list(sorted_dependencies)
-        del self._dependency_map[special_package_id]
-
-        # Remove "noise" dependencies (only referenced, not declared)
-        sorted_dependencies = filter(lambda x: x in self._dependency_map, sorted_dependencies)
-        return sorted_dependencies
+        return [item for layer in self.layers() for item in layer]
 
 
 def parse_package_gz(filename):
-    package_list = []
-    with gzip.open(filename, "rb") as f:
-        lines = f.read().decode()
+    with debdeps.open_index(filename) as f:
+        for stanza in debdeps.iter_stanzas(f):
+            package_desc = {k: v for k, v in stanza.items() if k and v}
 
-        packages = lines.split("\n\n")
-        
-        for p in packages:
-            package_desc = {}
-            items = p.split("\n")
+            if package_desc:
+                yield package_desc
 
-            for i in items:
-                j = i.split(":", 1)
 
-                key = j[0] if j[0] else None
-                val = j[1].lstrip() if len(j) > 1 else None
+def get_repo_contents(user_config):
+    index = {}
+    for repo, suite, dist, component, arch, url in debdeps.repo_targets(user_config):
+        filename = f"Packages.gz.{dist}-{component}-{arch}"
 
-                if not key or not val:
-                    continue
+        index.update({url: {"file": str(uuid.uuid4())}})
+        if not os.path.exists(filename):
+            with debdeps.metrics.span("fetch"):
+                debdeps.fetch_url(f"{url}/Packages.gz", filename)
 
-                package_desc[key] = val
+        with debdeps.metrics.span("parse"):
+            index[url]["index"] = list(parse_package_gz(filename))
+        debdeps.metrics.count("stanzas_parsed", len(index[url]["index"]))
 
-            if package_desc:
-                package_list.append(package_desc)
+        if not os.path.exists(f"{filename}.json"):
+            with open(f"{filename}.json", 'w') as f:
+                json.dump(index[url]["index"], f, indent=4)
 
-    return package_list
+        #os.remove(filename)
 
+    return index
 
-def get_repo_contents(user_config):
-    index = {}
-    for repo in user_config:
-        for suite in repo["suites"]:
-            for component in repo["components"]:
-                for arch in repo["archs"]:
-                    url = f"{repo['repo_url']}/dists/{repo['distro']}/{component}/binary-{arch}"
+class StanzaIndex(object):
+    """The stanzas of every repository behind deb-deps' candidate index.
 
-                    index.update({url: {"file": str(uuid.uuid4())}})
-                    if not os.path.exists(f"Packages.gz.{suite}-{component}-{arch}"):
-                        filename = wget.download(f"{url}/Packages.gz")
-                        os.rename("Packages.gz", f"Packages.gz.{suite}-{component}-{arch}")
+    Each stanza is loaded as a PackageRecord too, so identical stanzas
+    published in several repositories are merged by hash like deb-deps
+    does, and lookups go through the (name, architecture) CandidateIndex
+    with its Multi-Arch rules instead of a scan over every stanza.
+    """
 
-                    index[url]["index"] = parse_package_gz(f"Packages.gz.{suite}-{component}-{arch}")
+    def __init__(self, index, native="", pins=None):
+        stanzas = {}
+        records = {}
 
-                    if not os.path.exists(f"Packages.gz.{suite}-{component}-{arch}.json"):
-                        with open(f"Packages.gz.{suite}-{component}-{arch}.json", 'w') as f:
-                            json.dump(index[url]["index"], f, indent=4)
+        for url, contents in index.items():
+            records[url] = {"index": []}
+            for stanza in contents["index"]:
+                if stanza.get("Package"):
+                    record = debdeps.make_record(stanza, url)
+                    stanzas[id(record)] = stanza
+                    records[url]["index"].append(record)
 
-                    #os.remove(filename)
+        merged = debdeps.merge_indices(records, pins or {})
+        self._stanzas = {id(record): stanzas[id(record)] for record in merged}
+        self.candidates = debdeps.build_index(merged, native)
 
-    return index
+    def lookup(self, dep, arch=""):
+        """Return the records that can satisfy Dependency dep for a package of arch, best first."""
+        return self.candidates.candidates(dep, arch) or []
+
+    def stanza(self, record):
+        return self._stanzas[id(record)]
 
-def get_dependencies(package, index, debian_packages, dependency_map):
-    match = {}
-    matches = []
-    #print(index)
-    for x,y in index.items():
-        for z in y["index"]:
-            if z["Package"] == package["name"]:
-                matches.append(z)
-            elif "Provides" in z:
-                if package["name"] in z["Provides"]:
-                    matches.append(z)
-                
-    #matches = [z for x,y in index.items() for z in y["index"] if z["Package"] == package["pkg"]]
-
-    matches = [i for n, i in enumerate(matches) if i not in matches[n+1:]]
-    matches = sorted(matches, key=lambda k: k["Version"])
+
+def get_dependencies(package, index, debian_packages, dependency_map, arch=""):
+    match = None
+    matches = index.lookup(debdeps.package_dependency(package), arch)
 
     if "version" in package:
         if len(package["version"]) > 0:
-            match = next((x for x in matches if x["Version"] == package["version"]), None)
+            match = next((x for x in matches if x.version == package["version"]), None)
 
             if match:
-                print("BINGO")
+                logging.debug("exact version match %s %s", match.name, match.version)
         else:
             match = matches[0] if len(matches) > 0 else None
     else:
         match = matches[0] if len(matches) > 0 else None
 
-    debian_package = Package(match)
+    if match is None:
+        logging.warning("No match %s", package)
+        return
+
+    debian_package = Package(index.stanza(match))
+    # Already visited, which also ends the walk around dependency cycles
+    if debian_package.id in debian_packages:
+        return
+
     debian_packages[debian_package.id] = debian_package
     dependency_map[debian_package.id] = debian_package.dependencies
 
     for dep in debian_package.dependencies:
 
-        get_dependencies(dep, index, debian_packages, dependency_map)
+        get_dependencies({"name": dep}, index, debian_packages, dependency_map, match.arch)
 
 class Package(object):
     def __init__(self, package):
@@ -205,107 +284,78 @@ class Package(object):
 
     def _get_dependencies(self):
         dependencies = self._get('Depends') + ',' + self._get('Pre-Depends')
-        print(dependencies)
-        dependencies = re.split(r',|\|', dependencies)
-        print(dependencies)
+        # Only the first of each group of alternatives, like apt would try
+        dependencies = [group.split('|')[0] for group in dependencies.split(',')]
         dependencies = map(lambda x: re.sub(r'\(.*\)|:any', '', x).strip(), dependencies)
-        print(dependencies)
-        dependencies = filter(lambda x: x, dependencies)
-        print(dependencies)
-        dependencies = set(dependencies)
-        print(dependencies)
+        dependencies = set(filter(lambda x: x, dependencies))
+        logging.debug("%s depends on %s", self.id, dependencies)
         for dependency in dependencies:
             yield dependency
 
     def _get(self, key):
-        return self._metadata[key] if self._metadata[key] else ""
-
-
-def get_dependencies_2(package, index, debian_packages):
-    print(package)
-    # Package {"name", "version", "version_test"}
-    matches = []
-    match = {}
-    for x,y in index.items():
-        for z in y["index"]:
-            if z["Package"] == package["name"]:
-                matches.append(z)
-            elif "Provides" in z:
-                if next((w for w in z["Provides"].split(" ") if package["name"] == w), None):
-                    matches.append(z)
-    #matches = [z for x,y in index.items() for z in y["index"] if z["Package"] == package["name"]]
-
-    matches = [i for n, i in enumerate(matches) if i not in matches[n+1:]]
-    matches = sorted(matches, key=lambda k: k["Version"])
+        return self._metadata.get(key) or ""
+
+
+def get_dependencies_2(package, index, debian_packages, dependency_map=None, arch=""):
+    logging.debug("looking up %s", package)
+    # Package {"name", "version", "version_test"}, name may carry an :arch
+    # qualifier. arch is that of the package depending on it.
+    dep = debdeps.package_dependency(package)
+    matches = index.lookup(dep, arch)
 
     match = None
 
-    if "version" in package:
-        for x in matches:
-            ver_chk = callProcess(f"dpkg --compare-versions {x['Version']} {package['version_test']} {package['version']}", 
-                valid_returncodes=[0,1,2], inc_returncode=True)
-            if ver_chk[0] == 0:
-                print("Test Match")
-                match = x
-                break
-        if not match and len(matches) > 0:
-            match = matches[0]
-
-        print("Package version %s" % package["version"])
-    else:
-        match = matches[0] if len(matches) > 0 else None
+    if dep.version:
+        found = debdeps.satisfying(matches, dep)
+        if found:
+            match = found[0]
+    if not match and len(matches) > 0:
+        match = matches[0]
 
     if match:
-        if match["Package"] in debian_packages.keys():
-            print("Already accounted for")
-            return
-            #raise StopIteration()
-
-        print(match)
-        debian_packages[match["Package"]] = match
-        sub_depends = ""
-
-        if "Depends" in match:
-            sub_depends += match["Depends"]
-
-        if "Pre-Depends" in match:
-            sub_depends += match["Pre-Depends"]
-
-        if len(sub_depends) > 0:
-            # sub_depends = match["Depends"] + ", " + match["Pre-Depends"]
-            sub_depends = re.sub(", ", ",", sub_depends)
-            sub_depends = sub_depends.split(",")
-            print(f"Sub depends {sub_depends}")
-
-            for pck in sub_depends:
-                if len(pck.split(" ")) == 1:
-                    sub_pck = pck
-                    version_str = ""
-                else:
-                    sub_pck, version_str = re.sub('[()]', '', pck).split(" ", 1)
-                sub_pck_dict = {
-                    "name": sub_pck,
-                    "version": version_str.split(" ")[1] if len(version_str.split(" ")) > 1 else version_str,
-                    "version_test": version_str.split(" ")[0] if len(version_str.split(" ")) > 1 else ""
-                }
-                get_dependencies_2(sub_pck_dict, index, debian_packages)
-        else:
-            print("No Dependencies")
+        if match.key in debian_packages:
+            return match.key
+
+        logging.debug("selected %s %s %s", match.key, match.version, match.arch)
+        debian_packages[match.key] = index.stanza(match)
+        if dependency_map is not None:
+            dependency_map[match.key] = []
+
+        # Only the first of each group of alternatives, Pre-Depends included
+        for sub_pck in match.depends:
+            dep_id = get_dependencies_2(sub_pck._asdict(), index, debian_packages, dependency_map, match.arch)
+            if dependency_map is not None:
+                dependency_map[match.key].append(dep_id)
     else:
-        print("No match %s" % package)
+        logging.error("No match %s", package)
         raise StopIteration()
 
-    print(f"Package {package} retraverse")
+    return match.key
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('-p', '--packages', help='JSON file containing list of packages to bootstrap')
     parser.add_argument("-r", "--repos", help="Config file for bootstrap")
+    parser.add_argument("--log-level", choices=["debug", "info", "warning", "error"], default="info", help="debug traces every lookup and span")
+    parser.add_argument("--metrics", metavar="FILE", help="Collect stage timings and counters and write them as JSON to FILE (- for stdout)")
+    parser.add_argument("--profile", nargs="?", const="-", metavar="FILE", help="Run under cProfile, printing the top functions or saving pstats data to FILE")
 
     args  = parser.parse_args()
     vargs = vars(args)
+
+    logging.basicConfig(level=vargs["log_level"].upper(), stream=sys.stdout,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if vargs["metrics"] or vargs["log_level"] == "debug":
+        debdeps.enable_metrics()
+
+    profiler = cProfile.Profile() if vargs["profile"] else None
+    if profiler is not None:
+        profiler.enable()
+
     debian_packages = dict()
+    dependency_map = dict()
 
     with open(vargs["repos"], "r") as f:
        config = json.load(f)
@@ -313,10 +363,13 @@ if __name__ == "__main__":
     with open(vargs["packages"], "r") as f:
        packages = json.load(f)
 
-    index = get_repo_contents(config)
+    contents = get_repo_contents(config)
+    with debdeps.metrics.span("index"):
+        index = StanzaIndex(contents, debdeps.native_arch(config), debdeps.repo_pins(config))
 
-    for package in packages:
-        get_dependencies_2(package, index, debian_packages)
+    with debdeps.metrics.span("resolve"):
+        for package in packages:
+            get_dependencies_2(package, index, debian_packages, dependency_map)
 
     print("\n\n\n")
     print(debian_packages)
@@ -326,8 +379,16 @@ if __name__ == "__main__":
     for x,y in debian_packages.items():
         print(x)
     
-    # sorted_dependencies = TopologicalSort(dependency_map).sort()
-    # print(list(sorted_dependencies))
-    # sorted_dependencies = map(lambda package_id: debian_packages[package_id].Package, sorted_dependencies)
+    sorter = TopologicalSort(dependency_map)
+    for n, layer in enumerate(sorter.layers()):
+        print(f"Layer {n}: {' '.join(layer)}")
+
+    if profiler is not None:
+        profiler.disable()
+        debdeps.write_profile(profiler, vargs["profile"])
+
+    if debdeps.metrics.enabled:
+        debdeps.metrics.log()
 
-    # print(list(sorted_dependencies))
+    if vargs["metrics"]:
+        debdeps.write_metrics(vargs["metrics"])
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import struct
+import argparse
+
+
+PT_DYNAMIC = 2
+PT_INTERP = 3
+PT_LOAD = 1
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+DEFAULT_LIB_PATHS = [
+    "/lib", "/usr/lib", "/lib64", "/usr/lib64",
+    "/lib/x86_64-linux-gnu", "/usr/lib/x86_64-linux-gnu",
+    "/lib/i386-linux-gnu", "/usr/lib/i386-linux-gnu",
+    "/lib/aarch64-linux-gnu", "/usr/lib/aarch64-linux-gnu",
+    "/lib/arm-linux-gnueabihf", "/usr/lib/arm-linux-gnueabihf",
+]
+
+
+class ElfInfo(object):
+    __slots__ = ("path", "elf_class", "machine", "interp", "needed", "rpath", "runpath")
+
+    def __init__(self, path, elf_class, machine, interp=None, needed=(), rpath=(), runpath=()):
+        self.path = path
+        self.elf_class = elf_class
+        self.machine = machine
+        self.interp = interp
+        self.needed = needed
+        self.rpath = rpath
+        self.runpath = runpath
+
+
+def read_elf(path):
+    """Parse the ELF header, PT_INTERP and dynamic section of path without objdump.
+
+    Returns None for anything that is not an ELF file.
+    """
+    with open(path, "rb") as f:
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != b"\x7fELF":
+            return None
+
+        elf_class = ident[4]
+        endian = "<" if ident[5] == 1 else ">"
+
+        if elf_class == 2:
+            header = struct.unpack(endian + "HHIQQQIHHHHHH", f.read(48))
+            ph_fmt, ph_size = endian + "IIQQQQQQ", 56
+            dyn_fmt = endian + "qQ"
+        else:
+            header = struct.unpack(endian + "HHIIIIIHHHHHH", f.read(36))
+            ph_fmt, ph_size = endian + "IIIIIIII", 32
+            dyn_fmt = endian + "iI"
+
+        machine = header[1]
+        phoff, phentsize, phnum = header[4], header[8], header[9]
+
+        loads = []
+        dynamic = None
+        interp = None
+
+        for n in range(phnum):
+            f.seek(phoff + n * phentsize)
+            ph = struct.unpack(ph_fmt, f.read(ph_size))
+
+            if elf_class == 2:
+                p_type, _, p_offset, p_vaddr, _, p_filesz = ph[:6]
+            else:
+                p_type, p_offset, p_vaddr, _, p_filesz = ph[:5]
+
+            if p_type == PT_LOAD:
+                loads.append((p_vaddr, p_offset, p_filesz))
+            elif p_type == PT_DYNAMIC:
+                dynamic = (p_offset, p_filesz)
+            elif p_type == PT_INTERP:
+                f.seek(p_offset)
+                interp = f.read(p_filesz).rstrip(b"\0").decode()
+
+        if dynamic is None:
+            return ElfInfo(path, elf_class, machine, interp)
+
+        f.seek(dynamic[0])
+        raw = f.read(dynamic[1])
+        entry_size = struct.calcsize(dyn_fmt)
+
+        entries = []
+        strtab = None
+        for off in range(0, len(raw) - entry_size + 1, entry_size):
+            tag, val = struct.unpack_from(dyn_fmt, raw, off)
+            if tag == DT_NULL:
+                break
+            if tag == DT_STRTAB:
+                strtab = val
+            entries.append((tag, val))
+
+        # DT_STRTAB is a virtual address, map it back to a file offset
+        strtab_off = None
+        for vaddr, offset, filesz in loads:
+            if strtab is not None and vaddr <= strtab < vaddr + filesz:
+                strtab_off = strtab - vaddr + offset
+                break
+
+        def string(offset):
+            f.seek(strtab_off + offset)
+            chunk = b""
+            while b"\0" not in chunk:
+                data = f.read(256)
+                if not data:
+                    break
+                chunk += data
+            return chunk.split(b"\0", 1)[0].decode()
+
+        needed, rpath, runpath = [], [], []
+        if strtab_off is not None:
+            for tag, val in entries:
+                if tag == DT_NEEDED:
+                    needed.append(string(val))
+                elif tag == DT_RPATH:
+                    rpath.extend(string(val).split(":"))
+                elif tag == DT_RUNPATH:
+                    runpath.extend(string(val).split(":"))
+
+    return ElfInfo(path, elf_class, machine, interp, tuple(needed), tuple(rpath), tuple(runpath))
+
+
+def read_ld_so_cache(filename="/etc/ld.so.cache"):
+    """Return {soname: [paths...]} from a glibc ld.so.cache (new or combined format)."""
+    try:
+        with open(filename, "rb") as f:
+            data = f.read()
+    except OSError:
+        return {}
+
+    new_magic = b"glibc-ld.so.cache1.1"
+    base = 0
+
+    if data.startswith(b"ld.so-1.7.0"):
+        # Old format table first, the new format header follows 8-byte aligned
+        nlibs = struct.unpack_from("<I", data, 12)[0]
+        base = 16 + nlibs * 12
+        base = (base + 7) & ~7
+
+    if data[base:base + len(new_magic)] != new_magic:
+        return {}
+
+    # The cache is written in the host's byte order
+    nlibs = struct.unpack_from("=I", data, base + 20)[0]
+
+    def string(offset):
+        # String offsets are relative to the new format header
+        end = data.index(b"\0", base + offset)
+        return data[base + offset:end].decode()
+
+    cache = {}
+    for n in range(nlibs):
+        _, key, value, _, _ = struct.unpack_from("=iIIIQ", data, base + 48 + n * 24)
+        cache.setdefault(string(key), []).append(string(value))
+
+    return cache
+
+
+class ElfScanner(object):
+    """Collect the shared-library closure of many binaries in one pass.
+
+    Each file's dynamic section is read once (memoised by real path) and
+    each soname is resolved once per search path (memoised by soname and
+    the RPATH/RUNPATH in effect), so libc.so.6 is looked up a single time
+    no matter how many objects link it. Paths are resolved inside root.
+    """
+
+    def __init__(self, root="/", ld_so_cache=None):
+        self.root = root
+        self.ld_so_cache = read_ld_so_cache(self._in_root(ld_so_cache or "/etc/ld.so.cache"))
+        self._elf_memo = {}
+        self._soname_memo = {}
+
+    def _in_root(self, path):
+        return os.path.join(self.root, path.lstrip("/")) if self.root != "/" else path
+
+    def _from_root(self, path):
+        return "/" + os.path.relpath(path, self.root) if self.root != "/" else path
+
+    def realpath(self, path):
+        """os.path.realpath, except absolute symlinks stay inside root."""
+        if self.root == "/":
+            return os.path.realpath(path)
+
+        root = os.path.abspath(self.root)
+        parts = os.path.relpath(os.path.abspath(path), root).split("/")
+        resolved = root
+        hops = 0
+
+        while parts:
+            part = parts.pop(0)
+            if part in ("", "."):
+                continue
+            if part == "..":
+                if resolved != root:
+                    resolved = os.path.dirname(resolved)
+                continue
+
+            candidate = os.path.join(resolved, part)
+            if os.path.islink(candidate):
+                hops += 1
+                if hops > 40:
+                    raise OSError(f"Too many levels of symbolic links in {path}")
+
+                target = os.readlink(candidate)
+                if target.startswith("/"):
+                    resolved = root
+                parts = target.split("/") + parts
+            else:
+                resolved = candidate
+
+        return resolved
+
+    def link_chain(self, path):
+        """path, then every path its last component links to, each spelled as the loader would.
+
+        Only final components are followed, so /lib/x86_64-linux-gnu/libz.so.1
+        gives itself and /lib/x86_64-linux-gnu/libz.so.1.2.13 while a
+        symlinked directory (/lib on usrmerge) is kept as written. ".." is
+        only meaningful after resolving the directory before it, so paths
+        with one are listed by their real directory.
+        """
+        chain = []
+        while len(chain) <= 40:
+            parent = os.path.dirname(path)
+            if ".." in parent.split("/"):
+                parent = self.realpath(parent)
+                path = os.path.join(parent, os.path.basename(path))
+            chain.append(path)
+
+            link = os.path.join(self.realpath(parent), os.path.basename(path))
+            if not os.path.islink(link):
+                break
+
+            target = os.readlink(link)
+            path = self._in_root(target) if target.startswith("/") else os.path.join(parent, target)
+
+        return chain
+
+    def elf(self, path):
+        real = self.realpath(path)
+        if real not in self._elf_memo:
+            try:
+                self._elf_memo[real] = read_elf(real)
+            except (OSError, struct.error):
+                self._elf_memo[real] = None
+
+        return self._elf_memo[real]
+
+    def _compatible(self, path, owner):
+        info = self.elf(path)
+        return info is not None and info.elf_class == owner.elf_class and info.machine == owner.machine
+
+    def resolve(self, soname, owner):
+        """Find the file the dynamic loader would use for soname when loading owner."""
+        if "/" in soname:
+            return self._in_root(soname)
+
+        origin = os.path.dirname(self._from_root(owner.path))
+        expand = lambda d: d.replace("$ORIGIN", origin).replace("${ORIGIN}", origin)
+
+        # RPATH only applies when there is no RUNPATH
+        search = tuple(expand(d) for d in (owner.rpath if not owner.runpath else ()) + owner.runpath if d)
+        key = (soname, search, owner.elf_class, owner.machine)
+
+        if key not in self._soname_memo:
+            candidates = [os.path.join(d, soname) for d in search]
+            candidates += self.ld_so_cache.get(soname, [])
+            candidates += [os.path.join(d, soname) for d in DEFAULT_LIB_PATHS]
+
+            found = None
+            for candidate in candidates:
+                path = self._in_root(candidate)
+                if os.path.exists(self.realpath(path)) and self._compatible(path, owner):
+                    found = path
+                    break
+
+            self._soname_memo[key] = found
+
+        return self._soname_memo[key]
+
+    def scan(self, seeds):
+        """Return every file the seeds need, dependencies before dependents.
+
+        Seeds, PT_INTERP and found sonames are listed as the loader asks for
+        them, each followed by the files its symlinks lead to (see
+        link_chain), since a chroot needs both. Raises FileNotFoundError for
+        a soname that cannot be found.
+        """
+        ordered = []
+        seen = set()
+        started = set()
+        finished = set()
+        # Paths reaching a file whose dependencies are still being walked
+        # (a cycle back to it) wait until it is listed itself
+        waiting = {}
+
+        def add(path):
+            for p in self.link_chain(path):
+                if p not in seen:
+                    seen.add(p)
+                    ordered.append(p)
+
+        for seed in seeds:
+            seed = self._in_root(seed)
+            stack = [(seed, False)]
+
+            while stack:
+                path, expanded = stack.pop()
+                real = self.realpath(path)
+
+                if expanded:
+                    finished.add(real)
+                    add(path)
+                    for alias in waiting.pop(real, ()):
+                        add(alias)
+                    continue
+
+                if real in finished:
+                    add(path)
+                    continue
+                if real in started:
+                    waiting.setdefault(real, []).append(path)
+                    continue
+
+                info = self.elf(path)
+                stack.append((path, True))
+
+                if info is None:
+                    continue
+
+                # Guard against cycles: mark before walking the children
+                started.add(real)
+
+                deps = list(info.needed)
+                if info.interp:
+                    deps.insert(0, info.interp)
+
+                for soname in reversed(deps):
+                    dep = self.resolve(soname, info)
+                    if dep is None:
+                        raise FileNotFoundError(f"{soname} needed by {path} not found")
+                    stack.append((dep, False))
+
+        return [self._from_root(p) for p in ordered]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List the shared libraries needed to run binaries in a chroot')
+    parser.add_argument("seeds", nargs="+", help="Binaries or libraries to start from")
+    parser.add_argument("--root", default="/", help="Resolve all paths inside this directory")
+
+    args  = parser.parse_args()
+    vargs = vars(args)
+
+    scanner = ElfScanner(vargs["root"])
+
+    for path in scanner.scan(vargs["seeds"]):
+        print(path)
+
+    return
+
+
+if __name__ == '__main__':
+    sys.exit(main())
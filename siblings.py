@@ -0,0 +1,22 @@
+import os
+import sys
+import importlib.util
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def load_script(name):
+    """Return the module of the script name.py beside this file, loading it once.
+
+    The scripts are not importable by name, so each is registered in
+    sys.modules with its dashes turned into underscores. deb-deps.py run as
+    __main__ registers itself as "deb_deps" too, so a sibling loading it
+    from there gets the running module rather than a second copy.
+    """
+    module_name = name.replace("-", "_")
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPT_DIR, f"{name}.py"))
+        sys.modules[module_name] = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(sys.modules[module_name])
+
+    return sys.modules[module_name]
@@ -0,0 +1,142 @@
+import contextlib
+import gzip
+import http.server
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+# The scripts live at the top of the tree and load each other through siblings.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from siblings import load_script
+
+
+@pytest.fixture(scope="session")
+def debdeps():
+    return load_script("deb-deps")
+
+
+@pytest.fixture(scope="session")
+def debbench():
+    return load_script("deb-bench")
+
+
+@pytest.fixture(scope="session")
+def debtopo():
+    return load_script("deb-topological")
+
+
+@pytest.fixture(scope="session")
+def debstores():
+    return load_script("deb-stores")
+
+
+@pytest.fixture(scope="session")
+def debserver():
+    return load_script("deb-server")
+
+
+@pytest.fixture(scope="session")
+def debengine():
+    return load_script("deb-engine")
+
+
+@pytest.fixture
+def make_index(debdeps, tmp_path):
+    """Build the CandidateIndex of a Packages text, its stanzas separated by blank lines."""
+    def make(text, native=""):
+        filename = tmp_path / "Packages.gz"
+        with gzip.open(filename, "wt") as f:
+            f.write(text.strip() + "\n\n")
+
+        records = list(debdeps.parse_package_gz(str(filename), "http://mirror"))
+        return debdeps.build_index(debdeps.merge_indices({"http://mirror": {"index": records}}, {}), native)
+
+    return make
+
+
+class Mirror(object):
+    """A directory served over HTTP, with the (path, status) of every request it answered.
+
+    Every request takes delay seconds, and busy_max is the most it ever
+    answered at once.
+    """
+
+    def __init__(self, root, url):
+        self.root = root
+        self.url = url
+        self.requests = []
+        self.delay = 0
+        self.busy = 0
+        self.busy_max = 0
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._mtime = int(time.time())
+
+    def publish(self, path, data):
+        filename = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "wb") as f:
+            f.write(data)
+
+        # Last-Modified has one second resolution, so every change moves the
+        # clock on a second or revalidation would see it as unchanged
+        self._mtime += 1
+        os.utime(filename, (self._mtime, self._mtime))
+
+    def requested(self, suffix):
+        return [status for path, status in self.requests if path.endswith(suffix)]
+
+    def fail(self, path, *statuses):
+        """Answer the next requests of path with statuses, one each, before serving it again."""
+        self._failures.setdefault(f"/{path}", []).extend(statuses)
+
+    @contextlib.contextmanager
+    def answering(self, path):
+        with self._lock:
+            self.busy += 1
+            self.busy_max = max(self.busy_max, self.busy)
+            failures = self._failures.get(path)
+            status = failures.pop(0) if failures else None
+
+        try:
+            time.sleep(self.delay)
+            yield status
+        finally:
+            with self._lock:
+                self.busy -= 1
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    root = tmp_path / "mirror"
+    root.mkdir()
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=str(root), **kwargs)
+
+        def do_GET(self):
+            with served.answering(self.path) as status:
+                if status:
+                    self.send_error(status)
+                else:
+                    super().do_GET()
+
+        def log_request(self, code="-", size="-"):
+            served.requests.append((self.path, int(code)))
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    served = Mirror(str(root), f"http://127.0.0.1:{server.server_address[1]}")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield served
+
+    server.shutdown()
+    server.server_close()
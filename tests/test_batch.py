@@ -0,0 +1,63 @@
+import random
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def archive(debdeps, debbench, tmp_path_factory):
+    # Plenty of virtual packages with several providers, alternatives and
+    # cycles, so the batch memo is exercised where resolve() picks by context
+    filename = str(tmp_path_factory.mktemp("archive") / "Packages.gz")
+    debbench.generate_archive(filename, packages=3000, provides=0.3, alternatives=0.2, cycles=40, seed=5)
+
+    records = list(debdeps.parse_package_gz(filename, "http://mirror"))
+    return debdeps.build_index(debdeps.merge_indices({"http://mirror": {"index": records}}, {}))
+
+
+def targets(debdeps, index, count=300, seed=3):
+    rng = random.Random(seed)
+    names = sorted(index)
+    return [[debdeps.Dependency(name, "", "") for name in rng.sample(names, rng.randint(1, 40))]
+            for _ in range(count)]
+
+
+def keys(closure):
+    return [p.key for p in closure]
+
+
+def test_batch_matches_resolve(debdeps, archive):
+    batch = targets(debdeps, archive)
+
+    expected = [keys(debdeps.resolve(packages, archive, strict=False)) for packages in batch]
+    got = [keys(closure) for closure in debdeps.resolve_batch(batch, archive, strict=False)]
+
+    assert got == expected
+
+
+def test_batch_reuses_selected_providers(debdeps, archive):
+    # A root naming a virtual package after one of its providers is already
+    # in the closure must get that provider, not the preferred one
+    virtual = next(name for name, candidates in archive.items()
+                   if len(candidates) > 1 and all(c.name != name for c in candidates))
+    provider = archive[virtual][1]
+    packages = [debdeps.Dependency(provider.name, "", ""), debdeps.Dependency(virtual, "", "")]
+
+    closure = debdeps.resolve_batch([packages], archive)[0]
+
+    assert provider in closure
+    assert keys(closure) == keys(debdeps.resolve(packages, archive))
+
+
+def test_batch_pool_matches_in_process(debdeps, archive):
+    batch = targets(debdeps, archive, count=20)
+
+    pooled = debdeps.resolve_batch(batch, archive, strict=False, workers=2)
+
+    assert [keys(c) for c in pooled] == [keys(c) for c in debdeps.resolve_batch(batch, archive, strict=False)]
+
+
+def test_batch_strict_raises_like_resolve(debdeps, archive):
+    packages = [debdeps.Dependency("no-such-package", "", "")]
+
+    with pytest.raises(ValueError, match="Package not found no-such-package"):
+        debdeps.resolve_batch([packages], archive)
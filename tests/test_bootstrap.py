@@ -0,0 +1,241 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import urllib.error
+
+import pytest
+
+
+def tar_gz(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for path, data in files.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def deb(name, files):
+    members = [
+        ("debian-binary", b"2.0\n"),
+        ("control.tar.gz", tar_gz({"./control": f"Package: {name}\n".encode()})),
+        ("data.tar.gz", tar_gz(files)),
+    ]
+    out = b"!<arch>\n"
+    for member, data in members:
+        out += f"{member:<16}{0:<12}{0:<6}{0:<6}{100644:<8}{len(data):<10}`\n".encode() + data
+        out += b"\n" if len(data) % 2 else b""
+    return out
+
+
+def publish_packages(mirror, version, depends):
+    """Publish the packages of depends, {name: [names it depends on]}, each shipping usr/share/<name>/version."""
+    stanzas = []
+    for name, deps in depends.items():
+        data = deb(name, {f"./usr/share/{name}/version": f"{version}\n".encode()})
+        filename = f"pool/{name}_{version}_amd64.deb"
+        mirror.publish(filename, data)
+        stanzas.append(f"Package: {name}\nVersion: {version}\nArchitecture: amd64\nFilename: {filename}\n"
+                       f"Size: {len(data)}\nSHA256: {hashlib.sha256(data).hexdigest()}\n"
+                       + (f"Depends: {', '.join(deps)}\n" if deps else "") + "\n")
+    mirror.publish("dists/b/main/binary-amd64/Packages.gz", gzip.compress("".join(stanzas).encode(), mtime=0))
+
+
+@pytest.fixture
+def archive(debdeps, mirror, tmp_path, monkeypatch):
+    """Run deb-deps.py in tmp_path for the root app against the mirror; .publish(version) updates it."""
+    def publish(version):
+        publish_packages(mirror, version, {"app": ["lib"], "lib": []})
+
+    def run(*args):
+        monkeypatch.setattr(sys, "argv", ["deb-deps.py", "-r", "r.json", "-p", "p.json", *args])
+        return debdeps.main()
+
+    monkeypatch.chdir(tmp_path)
+    with open("r.json", "w") as f:
+        json.dump([{"repo_url": mirror.url, "distro": "b", "suites": ["release"], "components": ["main"], "archs": ["amd64"]}], f)
+    with open("p.json", "w") as f:
+        json.dump([{"name": "app"}], f)
+
+    run.publish = publish
+    return run
+
+
+def test_rootfs_unpacks_closure_through_artifact_cache(archive, capsys):
+    archive.publish("1")
+
+    archive("--rootfs", "root", "--download-dir", "debs", "--artifact-cache", "cache")
+
+    assert capsys.readouterr().out.splitlines()[-1] == "['app', 'lib']"
+    for name in ("app", "lib"):
+        with open(f"root/usr/share/{name}/version") as f:
+            assert f.read() == "1\n"
+    # Downloads are moved into the cache, with no .meta sidecars left behind
+    assert os.listdir("debs") == []
+
+
+def test_lock_write_hit_and_verify(archive, capsys):
+    archive.publish("1")
+
+    archive("--lock", "lock.json")
+    assert capsys.readouterr().out.splitlines()[-1] == "['app', 'lib']"
+
+    assert archive("--lock", "lock.json", "--verify-lock") is None
+    assert capsys.readouterr().out.splitlines() == ["Lock matches the current indices"]
+
+    # A hit takes the closure from the lock as is instead of resolving again
+    with open("lock.json") as f:
+        lock = json.load(f)
+    lock["closure"] = lock["closure"][:1]
+    with open("lock.json", "w") as f:
+        json.dump(lock, f)
+
+    archive("--lock", "lock.json")
+    assert capsys.readouterr().out.splitlines()[-1] == "['app']"
+
+    archive.publish("2")
+    assert archive("--lock", "lock.json", "--verify-lock") == 1
+    assert capsys.readouterr().out.splitlines() == ["Lock predates the current indices", "No longer in the indices: app"]
+
+    # A lock from older indices is replaced by a fresh resolve
+    archive("--lock", "lock.json")
+    assert capsys.readouterr().out.splitlines()[-1] == "['app', 'lib']"
+    with open("lock.json") as f:
+        assert [p["Version"] for p in json.load(f)["closure"]] == ["2", "2"]
+
+
+def cached_deb(cache, tmp_path, name, files):
+    data = deb(name, files)
+    sha256 = hashlib.sha256(data).hexdigest()
+    (tmp_path / f"{name}.deb").write_bytes(data)
+    return (sha256, cache.add_deb(sha256, str(tmp_path / f"{name}.deb")))
+
+
+def test_roots_do_not_share_inodes_with_the_cache(debstores, tmp_path):
+    cache = debstores.ArtifactCache(str(tmp_path / "cache"))
+    sha256, filename = cached_deb(cache, tmp_path, "app", {"./etc/app.conf": b"cached\n"})
+
+    debstores.unpack_deb(filename, str(tmp_path / "root"), sha256, cache)
+    with open(tmp_path / "root/etc/app.conf", "a") as f:
+        f.write("edited in the root\n")
+
+    tree = cache.ensure_tree(sha256, filename)
+    assert os.stat(os.path.join(tree, "etc/app.conf")).st_ino != os.stat(tmp_path / "root/etc/app.conf").st_ino
+    with open(os.path.join(tree, "etc/app.conf")) as f:
+        assert f.read() == "cached\n"
+
+
+def test_evict_keeps_only_what_running_builds_reference(debstores, tmp_path):
+    path = str(tmp_path / "cache")
+    builder = debstores.ArtifactCache(path, max_bytes=0)
+    old, _ = cached_deb(builder, tmp_path, "old", {})
+    os.utime(os.path.join(path, "objects", old), (0, 0))
+    # A build that died without cleaning up leaves an unlocked references file
+    with open(os.path.join(path, "builders", "dead"), "w") as f:
+        f.write(f"{old}\n")
+
+    with builder.use():
+        used, _ = cached_deb(builder, tmp_path, "used", {})
+
+        # Another process evicts while this build still holds the store
+        debstores.ArtifactCache(path, max_bytes=0).evict()
+        assert os.listdir(os.path.join(path, "objects")) == [used]
+        assert len(os.listdir(os.path.join(path, "builders"))) == 1
+
+    builder.evict()
+    assert os.listdir(os.path.join(path, "objects")) == []
+    assert os.listdir(os.path.join(path, "builders")) == []
+
+
+LEAVES = [f"l{n}" for n in range(8)]
+
+
+def test_async_batch_keeps_to_the_per_host_limit(archive, mirror, capsys):
+    publish_packages(mirror, "1", {"app": LEAVES, **{name: [] for name in LEAVES}})
+    with open("q.json", "w") as f:
+        json.dump([{"name": "l0"}], f)
+    mirror.delay = 0.05
+
+    archive("--async", "--batch", "p.json", "q.json", "--rootfs", "roots", "--per-host", "2")
+
+    assert capsys.readouterr().out.splitlines()[-2:] == [f"p.json: {['app'] + LEAVES}", "q.json: ['l0']"]
+    assert os.path.exists("roots/p/usr/share/l7/version") and os.path.exists("roots/q/usr/share/l0/version")
+    assert mirror.busy_max == 2
+
+
+def test_bootstrap_retries_transient_failures(debdeps, debengine, archive, mirror):
+    archive.publish("1")
+    with open("r.json") as f:
+        config = json.load(f)
+    app = [debdeps.Dependency("app", "", "")]
+
+    mirror.fail("pool/lib_1_amd64.deb", 503, 429)
+    mirror.fail("dists/b/main/binary-amd64/Packages.gz", 500)
+    debengine.bootstrap(config, [(app, "root")], cache_dir=None, backoff=0.01)
+
+    assert mirror.requested("/lib_1_amd64.deb") == [503, 429, 200]
+    assert mirror.requested("/Packages.gz") == [500, 200]
+    assert os.path.exists("root/usr/share/lib/version")
+
+    # Neither a 404 nor a failure outlasting the retries is retried again
+    mirror.fail("pool/app_1_amd64.deb", 404)
+    with pytest.raises(urllib.error.HTTPError, match="404"):
+        debengine.bootstrap(config, [(app, "again")], cache_dir=None, download_dir="fresh", backoff=0.01)
+    mirror.fail("pool/app_1_amd64.deb", 503, 503)
+    with pytest.raises(urllib.error.HTTPError, match="503"):
+        debengine.bootstrap(config, [(app, "again")], cache_dir=None, download_dir="fresh", retries=1, backoff=0.01)
+    assert mirror.requested("/app_1_amd64.deb")[1:] == [404, 503, 503]
+
+
+def test_window_bounds_packages_downloaded_but_not_extracted(debdeps, debengine, archive, mirror, monkeypatch):
+    publish_packages(mirror, "1", {"app": LEAVES, **{name: [] for name in LEAVES}})
+    with open("r.json") as f:
+        config = json.load(f)
+
+    fetched = []
+    pending = []
+    fetch_deb = debdeps.fetch_deb
+
+    def fetch(pkg_inst, *args):
+        # Fetched packages not extracted yet, this one included
+        fetched.append(pkg_inst.name)
+        pending.append(len([name for name in fetched if not os.path.exists(f"root/usr/share/{name}/version")]))
+        return fetch_deb(pkg_inst, *args)
+
+    monkeypatch.setattr(debdeps, "fetch_deb", fetch)
+    debengine.bootstrap(config, [([debdeps.Dependency("app", "", "")], "root")], cache_dir=None, window=2)
+
+    assert sorted(fetched) == sorted(["app"] + LEAVES)
+    assert max(pending) == 2
+
+
+@pytest.mark.parametrize("mode", [[], ["--async"]])
+def test_second_image_starts_from_the_first_ones_prefix(archive, mirror, mode):
+    publish_packages(mirror, "1", {"app": ["mid"], "tool": ["mid"], "mid": ["lib"], "lib": []})
+
+    archive("--rootfs", "one", "--snapshots", "snaps", *mode)
+    with open("p.json", "w") as f:
+        json.dump([{"name": "tool"}], f)
+    mirror.requests.clear()
+    archive("--rootfs", "two", "--snapshots", "snaps", "--download-dir", "fresh", *mode)
+
+    # lib and mid come from the layers the first image recorded
+    assert [path for path, _ in mirror.requests if path.endswith(".deb")] == ["/pool/tool_1_amd64.deb"]
+    assert sorted(os.listdir("two/usr/share")) == ["lib", "mid", "tool"]
+
+    layers = {}
+    for key in os.listdir("snaps/objects"):
+        with open(f"snaps/objects/{key}/packages") as f:
+            layers[tuple(sorted(p[0] for p in json.load(f)))] = f"snaps/objects/{key}/tree"
+    assert sorted(layers) == [("app", "lib", "mid"), ("lib",), ("lib", "mid"), ("lib", "mid", "tool")]
+
+    # Each layer holds only what it wrote, in inodes of its own
+    assert os.listdir(f"{layers['lib', 'mid']}/usr/share") == ["mid"]
+    for root in ("one", "two"):
+        snapshot = os.stat(f"{layers['lib', 'mid']}/usr/share/mid/version")
+        assert os.stat(f"{root}/usr/share/mid/version").st_ino != snapshot.st_ino
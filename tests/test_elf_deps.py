@@ -0,0 +1,99 @@
+import os
+import struct
+
+import pytest
+
+from siblings import load_script
+
+
+@pytest.fixture(scope="module")
+def elfdeps():
+    return load_script("elf-deps")
+
+
+def elf(interp=None, needed=(), runpath=()):
+    """A minimal x86-64 shared object with just PT_INTERP and a dynamic section."""
+    strtab = b"\0"
+
+    def string(s):
+        nonlocal strtab
+        strtab += s.encode() + b"\0"
+        return len(strtab) - len(s) - 1
+
+    dynamic = [(1, string(name)) for name in needed]
+    if runpath:
+        dynamic.append((29, string(":".join(runpath))))
+
+    interp = interp.encode() + b"\0" if interp else b""
+    interp_off = 64 + 56 * (3 if interp else 2)
+    strtab_off = interp_off + len(interp)
+    dynamic = b"".join(struct.pack("<qQ", tag, val) for tag, val in dynamic + [(5, strtab_off), (0, 0)])
+    dynamic_off = strtab_off + len(strtab)
+    size = dynamic_off + len(dynamic)
+
+    # Loaded at address 0, so virtual addresses are file offsets
+    headers = [(1, 0, size)] + ([(3, interp_off, len(interp))] if interp else []) + [(2, dynamic_off, len(dynamic))]
+
+    return (
+        b"\x7fELF" + bytes([2, 1, 1]) + bytes(9)
+        + struct.pack("<HHIQQQIHHHHHH", 3, 62, 1, 0, 64, 0, 0, 64, 56, len(headers), 64, 0, 0)
+        + b"".join(struct.pack("<IIQQQQQQ", p_type, 4, off, off, off, n, n, 8) for p_type, off, n in headers)
+        + interp + strtab + dynamic
+    )
+
+
+@pytest.fixture
+def root(tmp_path):
+    # A usrmerge tree: /lib, /lib64 and /bin are symlinks into /usr
+    files = {
+        "usr/lib/x86_64-linux-gnu/ld-linux-x86-64.so.2": elf(),
+        "usr/lib/x86_64-linux-gnu/libc.so.6": elf(needed=["ld-linux-x86-64.so.2"]),
+        "usr/lib/x86_64-linux-gnu/libz.so.1.2.13": elf(needed=["libc.so.6"]),
+        "usr/lib/app/libpriv.so": elf(needed=["libcycle.so", "libc.so.6"], runpath=["$ORIGIN"]),
+        "usr/lib/app/libcycle.so": elf(needed=["libpriv.so"], runpath=["$ORIGIN"]),
+        "usr/bin/app": elf("/lib64/ld-linux-x86-64.so.2", ["libpriv.so", "libz.so.1", "libc.so.6"],
+                           ["$ORIGIN/../lib/app"]),
+    }
+    links = {
+        "lib": "usr/lib",
+        "lib64": "usr/lib64",
+        "bin": "usr/bin",
+        "usr/lib64/ld-linux-x86-64.so.2": "/lib/x86_64-linux-gnu/ld-linux-x86-64.so.2",
+        "usr/lib/x86_64-linux-gnu/libz.so.1": "libz.so.1.2.13",
+    }
+
+    for path, data in files.items():
+        os.makedirs(tmp_path / os.path.dirname(path), exist_ok=True)
+        (tmp_path / path).write_bytes(data)
+    for path, target in links.items():
+        os.makedirs(tmp_path / os.path.dirname(path), exist_ok=True)
+        os.symlink(target, tmp_path / path)
+
+    return str(tmp_path)
+
+
+def test_paths_are_listed_as_the_loader_asks_for_them(elfdeps, root):
+    listed = elfdeps.ElfScanner(root).scan(["/bin/app"])
+
+    # The exact PT_INTERP path, then the absolute symlink it is
+    assert listed[:2] == ["/lib64/ld-linux-x86-64.so.2", "/lib/x86_64-linux-gnu/ld-linux-x86-64.so.2"]
+    assert listed[-1] == "/bin/app"
+    # A symlinked soname comes with its target; the usrmerge twins under /usr are not listed
+    assert listed.index("/lib/x86_64-linux-gnu/libz.so.1") + 1 == listed.index("/lib/x86_64-linux-gnu/libz.so.1.2.13")
+    assert not [p for p in listed if p.startswith(("/usr/bin", "/usr/lib/x86_64-linux-gnu", "/usr/lib64"))]
+    assert len(listed) == len(set(listed))
+
+
+def test_runpath_and_cycles(elfdeps, root):
+    listed = elfdeps.ElfScanner(root).scan(["/bin/app"])
+
+    # $ORIGIN/../lib/app resolved from /usr/bin, and the libpriv <-> libcycle loop walked once
+    assert {"/usr/lib/app/libpriv.so", "/usr/lib/app/libcycle.so"} <= set(listed)
+    assert listed.index("/lib/x86_64-linux-gnu/libc.so.6") < listed.index("/usr/lib/app/libpriv.so")
+
+
+def test_missing_soname_raises(elfdeps, root):
+    os.remove(os.path.join(root, "usr/lib/app/libcycle.so"))
+
+    with pytest.raises(FileNotFoundError, match="libcycle.so"):
+        elfdeps.ElfScanner(root).scan(["/bin/app"])
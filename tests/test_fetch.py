@@ -0,0 +1,160 @@
+import difflib
+import gzip
+import hashlib
+import os
+
+import pytest
+
+
+INDEX = "dists/b/main/binary-amd64"
+
+
+def config(mirror):
+    return [{"repo_url": mirror.url, "distro": "b", "suites": ["release"], "components": ["main"], "archs": ["amd64"]}]
+
+
+def packages(version, count=50):
+    return "".join(
+        f"Package: p{n}\nVersion: {version if n % 7 == 0 else 1}\nArchitecture: amd64\n\n" for n in range(count)
+    ).encode()
+
+
+def hash_line(data, name):
+    return f" {hashlib.sha256(data).hexdigest()} {len(data)} {name}\n"
+
+
+def release(files):
+    return ("SHA256:\n" + "".join(hash_line(data, path) for path, data in files.items())).encode()
+
+
+def ed_script(old, new):
+    # What diff --ed prints: commands from the end of the file backwards
+    old, new = old.splitlines(True), new.splitlines(True)
+    script = []
+    for op, i1, i2, j1, j2 in reversed(difflib.SequenceMatcher(None, old, new).get_opcodes()):
+        if op == "delete":
+            script.append(f"{i1 + 1},{i2}d\n".encode())
+        elif op in ("replace", "insert"):
+            script.append(f"{i1 + 1},{i2}c\n".encode() if op == "replace" else f"{i1}a\n".encode())
+            script.extend(new[j1:j2])
+            script.append(b".\n")
+    return b"".join(script)
+
+
+def publish_pdiffs(mirror, history, patches, merged=False):
+    """Publish history[-1] as the index with patches[n] leading from history[n] to history[n + 1].
+
+    merged publishes Debian's layout instead: patches[n] leads from
+    history[n] straight to history[-1] and is named T-<current>-F-<from>.
+    """
+    current = history[-1]
+    names = [f"2024-01-0{n + 1}-0000.00" for n in range(len(patches))]
+    patch_names = [f"T-2024-01-0{len(patches) + 1}-0000.00-F-{name}" for name in names] if merged else names
+    gzipped = [gzip.compress(patch, mtime=0) for patch in patches]
+
+    mirror.publish(f"{INDEX}/Packages.diff/Index", (
+        f"SHA256-Current: {hashlib.sha256(current).hexdigest()} {len(current)}\n"
+        + "SHA256-History:\n" + "".join(hash_line(data, name) for data, name in zip(history, names))
+        + "SHA256-Patches:\n" + "".join(hash_line(patch, name) for patch, name in zip(patches, patch_names))
+        + "SHA256-Download:\n" + "".join(hash_line(data, f"{name}.gz") for data, name in zip(gzipped, patch_names))
+        + ("X-Patch-Precedence: merged\n" if merged else "")
+    ).encode())
+    for data, name in zip(gzipped, patch_names):
+        mirror.publish(f"{INDEX}/Packages.diff/{name}.gz", data)
+
+    publish_index(mirror, current, pdiff=True)
+
+
+def publish_index(mirror, data, pdiff=False):
+    files = {"main/binary-amd64/Packages": data, "main/binary-amd64/Packages.gz": gzip.compress(data, mtime=0)}
+    for path, contents in files.items():
+        mirror.publish(f"dists/b/{path}", contents)
+
+    if pdiff:
+        with open(os.path.join(mirror.root, INDEX, "Packages.diff/Index"), "rb") as f:
+            files["main/binary-amd64/Packages.diff/Index"] = f.read()
+    mirror.publish("dists/b/Release", release(files))
+
+
+def sync(debdeps, mirror, tmp_path):
+    [(_, filename)] = debdeps.fetch_repo_files(config(mirror), download_dir=str(tmp_path / "client"))
+    with debdeps.open_index(filename) as f:
+        return f.read()
+
+
+def test_no_release_revalidates_with_304(debdeps, mirror, tmp_path):
+    mirror.publish(f"{INDEX}/Packages.gz", gzip.compress(packages(1), mtime=0))
+
+    assert sync(debdeps, mirror, tmp_path) == packages(1)
+    assert sync(debdeps, mirror, tmp_path) == packages(1)
+    assert mirror.requested("/Release") == [404, 404]
+    assert mirror.requested("/Packages.gz") == [200, 304]
+
+    mirror.publish(f"{INDEX}/Packages.gz", gzip.compress(packages(2), mtime=0))
+
+    assert sync(debdeps, mirror, tmp_path) == packages(2)
+    assert mirror.requested("/Packages.gz") == [200, 304, 200]
+
+
+def test_release_verifies_index(debdeps, mirror, tmp_path):
+    publish_index(mirror, packages(1))
+
+    assert sync(debdeps, mirror, tmp_path) == packages(1)
+    fetched = len(mirror.requested("/Packages") + mirror.requested("/Packages.gz"))
+
+    # A local copy matching Release is used without asking for the index again
+    assert sync(debdeps, mirror, tmp_path) == packages(1)
+    assert len(mirror.requested("/Packages") + mirror.requested("/Packages.gz")) == fetched
+
+    mirror.publish("dists/b/Release", release({"main/binary-amd64/Packages": packages(2),
+                                               "main/binary-amd64/Packages.gz": gzip.compress(packages(2), mtime=0)}))
+    with pytest.raises(ValueError, match="does not match"):
+        sync(debdeps, mirror, tmp_path)
+
+
+def test_pdiff_chain_updates_in_place(debdeps, mirror, tmp_path):
+    publish_pdiffs(mirror, [packages(1)], [])
+    sync(debdeps, mirror, tmp_path)
+
+    history = [packages(1), packages(2), packages(3)]
+    publish_pdiffs(mirror, history, [ed_script(old, new) for old, new in zip(history, history[1:])])
+    mirror.requests.clear()
+
+    assert sync(debdeps, mirror, tmp_path) == packages(3)
+    assert mirror.requested(".00.gz") == [200, 200]
+    assert mirror.requested("/Packages") + mirror.requested("/Packages.gz") == []
+    # Patches are removed once applied and leave no .meta sidecars behind
+    assert not [name for name in os.listdir(tmp_path / "client") if ".00" in name]
+
+
+def test_merged_pdiff_applies_one_patch_from_the_local_state(debdeps, mirror, tmp_path):
+    publish_pdiffs(mirror, [packages(1), packages(2)], [ed_script(packages(1), packages(2))], merged=True)
+    assert sync(debdeps, mirror, tmp_path) == packages(2)
+
+    history = [packages(1), packages(2), packages(3), packages(4)]
+    publish_pdiffs(mirror, history, [ed_script(old, packages(4)) for old in history[:-1]], merged=True)
+    mirror.requests.clear()
+
+    assert sync(debdeps, mirror, tmp_path) == packages(4)
+    assert [path.rsplit("/", 1)[1] for path, _ in mirror.requests if path.endswith(".00.gz")] == [
+        "T-2024-01-04-0000.00-F-2024-01-02-0000.00.gz"]
+    assert mirror.requested("/Packages") + mirror.requested("/Packages.gz") == []
+
+
+def test_broken_pdiff_falls_back_to_full_download(debdeps, mirror, tmp_path):
+    publish_pdiffs(mirror, [packages(1)], [])
+    sync(debdeps, mirror, tmp_path)
+
+    # The second patch opens a text block it never terminates
+    history = [packages(1), packages(2), packages(3)]
+    publish_pdiffs(mirror, history, [ed_script(packages(1), packages(2)), b"1a\nPackage: stray\n"])
+    mirror.requests.clear()
+
+    assert sync(debdeps, mirror, tmp_path) == packages(3)
+    assert len(mirror.requested("/Packages") + mirror.requested("/Packages.gz")) == 1
+
+
+@pytest.mark.parametrize("patch", [b"9999d\n", b"0,3c\nx\n.\n", b"5x\n"])
+def test_malformed_ed_patch_raises_value_error(debdeps, patch):
+    with pytest.raises(ValueError):
+        debdeps.apply_ed_patch([b"a\n", b"b\n"], patch.splitlines(True))
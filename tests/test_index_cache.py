@@ -0,0 +1,28 @@
+import gzip
+import os
+
+
+CONFIG = [{"repo_url": "http://mirror", "distro": "b", "suites": ["s"], "components": ["main"], "archs": ["amd64"]}]
+
+
+def write_packages(filename, version):
+    with gzip.open(filename, "wt") as f:
+        f.write(f"Package: app\nVersion: {version}\nArchitecture: amd64\n\n")
+
+
+def test_new_index_replaces_stale_pickles(debdeps, tmp_path):
+    filename = str(tmp_path / "Packages.gz")
+    cache_dir = str(tmp_path / "cache")
+    files = [("http://mirror/dists/s/main/binary-amd64", filename)]
+
+    write_packages(filename, "1")
+    debdeps.load_repo_index(CONFIG, cache_dir=cache_dir, files=files)
+    # Another configuration sharing the directory keeps its own index
+    debdeps.load_repo_index([dict(CONFIG[0], pins={"s": 990})], cache_dir=cache_dir, files=files)
+    open(os.path.join(cache_dir, f"index-{'0' * 64}.pickle"), "wb").close()
+
+    write_packages(filename, "2")
+    bindex = debdeps.load_repo_index(CONFIG, cache_dir=cache_dir, files=files)[2]
+
+    assert [p.version for p in bindex["app"]] == ["2"]
+    assert len([name for name in os.listdir(cache_dir) if name.startswith("index-")]) == 2
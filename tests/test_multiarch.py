@@ -0,0 +1,106 @@
+import pytest
+
+
+ARCHIVE = """
+Package: libc
+Version: 1
+Architecture: amd64
+Multi-Arch: same
+
+Package: libc
+Version: 1
+Architecture: i386
+Multi-Arch: same
+
+Package: perl
+Version: 1
+Architecture: amd64
+Multi-Arch: allowed
+
+Package: perl
+Version: 1
+Architecture: i386
+Multi-Arch: allowed
+
+Package: make
+Version: 1
+Architecture: i386
+Multi-Arch: foreign
+
+Package: data
+Version: 1
+Architecture: all
+
+Package: tool
+Version: 1
+Architecture: i386
+
+Package: mawk
+Version: 1
+Architecture: amd64
+Provides: awk
+"""
+
+
+@pytest.fixture
+def index(make_index):
+    return make_index(ARCHIVE, native="amd64")
+
+
+def found(debdeps, index, name, arch="", qualifier=""):
+    return [(p.name, p.arch) for p in index.candidates(debdeps.Dependency(name, "", "", qualifier), arch) or []]
+
+
+def test_same_packages_of_foreign_architectures_get_qualified_keys(index):
+    assert index.multiarch
+    assert sorted(p.key for name in ("libc", "perl") for p in index[name]) == ["libc", "libc:i386", "perl", "perl"]
+
+
+@pytest.mark.parametrize("name, arch, expected", [
+    # same and unmarked packages only satisfy their own architecture
+    ("libc", "amd64", [("libc", "amd64")]),
+    ("libc", "i386", [("libc", "i386")]),
+    # foreign satisfies every architecture
+    ("make", "amd64", [("make", "i386")]),
+    # allowed without :any is like same
+    ("perl", "i386", [("perl", "i386")]),
+    # all counts as native, both as a candidate and as a depender
+    ("data", "amd64", [("data", "all")]),
+    ("data", "i386", []),
+    ("libc", "all", [("libc", "amd64")]),
+    # Virtual packages follow their providers
+    ("awk", "amd64", [("mawk", "amd64")]),
+    ("awk", "i386", []),
+])
+def test_candidates_follow_multi_arch(debdeps, index, name, arch, expected):
+    assert found(debdeps, index, name, arch) == expected
+
+
+@pytest.mark.parametrize("name, arch, qualifier, expected", [
+    # :any accepts allowed packages of every architecture, but not same ones
+    ("perl", "i386", "any", [("perl", "amd64"), ("perl", "i386")]),
+    ("libc", "i386", "any", [("libc", "i386")]),
+    ("libc", "i386", "native", [("libc", "amd64")]),
+    ("libc", "amd64", "i386", [("libc", "i386")]),
+    ("data", "i386", "native", [("data", "all")]),
+])
+def test_qualifiers(debdeps, index, name, arch, qualifier, expected):
+    assert found(debdeps, index, name, arch, qualifier) == expected
+
+
+def test_root_falls_back_to_any_architecture(debdeps, index):
+    # Nothing native provides tool: a root takes the i386 one, as apt does
+    # for a name on its command line, but a dependency of a package does not
+    assert found(debdeps, index, "tool") == [("tool", "i386")]
+    assert found(debdeps, index, "tool", "amd64") == []
+    assert found(debdeps, index, "tool", qualifier="amd64") == []
+    # Where something native does, the root takes only that
+    assert found(debdeps, index, "libc") == [("libc", "amd64")]
+
+
+def test_single_architecture_is_not_narrowed(debdeps, make_index):
+    index = make_index("Package: tool\nVersion: 1\nArchitecture: i386\n\nPackage: data\nVersion: 1\nArchitecture: all")
+
+    assert not index.multiarch
+    assert index.native == "i386"
+    assert found(debdeps, index, "tool", "amd64") == [("tool", "i386")]
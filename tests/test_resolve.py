@@ -0,0 +1,127 @@
+from collections import defaultdict
+
+import pytest
+
+
+LIBS = """
+Package: lib
+Version: 1
+Architecture: amd64
+
+Package: lib
+Version: 2
+Architecture: amd64
+
+Package: b
+Version: 1
+Architecture: amd64
+Depends: lib
+
+Package: a
+Version: 1
+Architecture: amd64
+Depends: lib (<< 2)
+"""
+
+
+def names(closure):
+    return [(p.name, p.version) for p in closure]
+
+
+def roots(debdeps, *names):
+    return [debdeps.Dependency(name, "", "") for name in names]
+
+
+def test_selected_key_is_not_added_twice(debdeps, make_index):
+    index = make_index(LIBS)
+
+    # b selects lib 2 first, which a's (<< 2) cannot use
+    with pytest.raises(ValueError, match="lib << 2"):
+        debdeps.resolve(roots(debdeps, "b", "a"), index)
+
+    assert names(debdeps.resolve(roots(debdeps, "b", "a"), index, strict=False)) == [("b", "1"), ("lib", "2"), ("a", "1")]
+    assert names(debdeps.resolve(roots(debdeps, "a", "b"), index)) == [("a", "1"), ("lib", "1"), ("b", "1")]
+
+
+def test_batch_keeps_one_record_per_key(debdeps, make_index):
+    index = make_index(LIBS)
+    targets = [roots(debdeps, "b", "a"), roots(debdeps, "a", "b")]
+
+    expected = [names(debdeps.resolve(packages, index, strict=False)) for packages in targets]
+    assert [names(closure) for closure in debdeps.resolve_batch(targets, index, strict=False)] == expected
+
+
+def test_metrics_count_lookups_and_version_scans(debdeps, make_index, monkeypatch):
+    index = make_index(LIBS)
+    monkeypatch.setattr(debdeps.metrics, "counters", defaultdict(int))
+
+    debdeps.resolve(roots(debdeps, "a"), index)
+    assert debdeps.metrics.counters == {}
+
+    monkeypatch.setattr(debdeps.metrics, "enabled", True)
+    debdeps.resolve(roots(debdeps, "a"), index)
+    assert debdeps.metrics.counters == {"candidate_lookups": 2, "candidates_examined": 3, "version_scans": 1}
+
+
+def stanzas(*specs):
+    """Packages text of (name, fields) specs, each at version 1 unless fields say otherwise."""
+    return "\n".join(
+        f"Package: {name}\n" + ("" if "Version:" in fields else "Version: 1\n") + "Architecture: amd64\n" + fields
+        for name, fields in specs
+    )
+
+
+def test_alternatives_backjump_past_unrelated_choices(debdeps, make_index):
+    # z only clashes with a; the m and n choices made since have nothing to
+    # do with it, so one backjump lands straight on a | b
+    index = make_index(stanzas(
+        ("root", "Depends: a | b, m1 | m2, n1 | n2, z\n"),
+        ("a", ""), ("b", ""), ("m1", ""), ("m2", ""), ("n1", ""), ("n2", ""),
+        ("z", "Conflicts: a\n"),
+    ))
+
+    closure = debdeps.resolve_alternatives(roots(debdeps, "root"), index, max_steps=1)
+    assert [p.name for p in closure] == ["root", "b", "m1", "n1", "z"]
+
+
+def test_alternatives_honour_conflicts_and_breaks(debdeps, make_index):
+    index = make_index(stanzas(
+        ("app", "Depends: web, tool\n"),
+        ("web", "Depends: libssl1 | libssl3\n"),
+        ("tool", "Breaks: libssl1\n"),
+        ("libssl1", ""), ("libssl3", ""),
+        ("old", "Conflicts: lib (<< 2)\n"),
+        ("lib", "Version: 1\n"), ("lib", "Version: 2\n"),
+        ("pinned", "Depends: lib (<< 2)\n"),
+    ))
+
+    # tool's Breaks sends web back to its second alternative
+    closure = debdeps.resolve_alternatives(roots(debdeps, "app"), index)
+    assert [p.name for p in closure] == ["app", "web", "libssl3", "tool"]
+
+    # A versioned Conflicts only rules out the versions it names, on either side
+    closure = debdeps.resolve_alternatives(roots(debdeps, "old", "lib"), index)
+    assert names(closure) == [("old", "1"), ("lib", "2")]
+    with pytest.raises(ValueError, match="Nothing installable satisfies lib"):
+        debdeps.resolve_alternatives(roots(debdeps, "old", "pinned"), index)
+    with pytest.raises(ValueError, match="Nothing installable satisfies old"):
+        debdeps.resolve_alternatives(roots(debdeps, "pinned", "old"), index)
+
+
+def test_alternatives_allow_conflicting_with_a_virtual_package_one_provides(debdeps, make_index):
+    # Every mail transport agent provides and conflicts with the virtual
+    # name, so only one can be installed, but that one does not block itself
+    mta = "Provides: mail-transport-agent\nConflicts: mail-transport-agent\n"
+    index = make_index(stanzas(
+        ("exim", mta), ("postfix", mta),
+        ("mailer", "Depends: mail-transport-agent\n"),
+    ))
+
+    assert [p.name for p in debdeps.resolve_alternatives(roots(debdeps, "mailer"), index)] == ["mailer", "exim"]
+    # mailer first picks exim, which then blocks postfix until mailer takes it instead
+    closure = debdeps.resolve_alternatives(roots(debdeps, "mailer", "postfix"), index)
+    assert [p.name for p in closure] == ["mailer", "postfix"]
+    assert [p.name for p in debdeps.resolve_alternatives(roots(debdeps, "postfix", "mailer"), index)] == [
+        "postfix", "mailer"]
+    with pytest.raises(ValueError, match="Nothing installable satisfies postfix"):
+        debdeps.resolve_alternatives(roots(debdeps, "exim", "postfix"), index)
@@ -0,0 +1,58 @@
+import gzip
+import json
+import socket
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def server(debdeps, debserver, tmp_path):
+    # app only resolves through its second alternative, so resolve() fails
+    # on it where resolve_alternatives() picks b
+    filename = tmp_path / "Packages.gz"
+    with gzip.open(filename, "wt") as f:
+        f.write("Package: app\nVersion: 1\nArchitecture: amd64\nDepends: gone | b\n\n"
+                "Package: b\nVersion: 1\nArchitecture: amd64\n\n")
+
+    records = list(debdeps.parse_package_gz(str(filename), "http://mirror"))
+    index = debdeps.build_index(debdeps.merge_indices({"http://mirror": {"index": records}}, {}))
+
+    class StaticServer(debserver.ResolverServer):
+        def load(self):
+            self.state = ("static", index)
+
+    def start(alternatives=False):
+        socket_path = str(tmp_path / "resolver.sock")
+        srv = StaticServer(socket_path, None, {}, {}, alternatives=alternatives)
+        threading.Thread(target=srv.serve, daemon=True).start()
+        servers.append(srv)
+        return socket_path
+
+    servers = []
+    yield start
+    for srv in servers:
+        srv.shutdown()
+
+
+def test_request_picks_resolver(debdeps, debserver, server):
+    socket_path = server()
+    app = [debdeps.Dependency("app", "", "")]
+
+    response = debserver.request_resolve(socket_path, app, alternatives=True)
+    assert [p["Package"] for p in response["closure"]] == ["app", "b"]
+
+    with pytest.raises(ValueError, match="gone"):
+        debserver.request_resolve(socket_path, app)
+
+
+def test_server_default_applies_without_flag(server):
+    socket_path = server(alternatives=True)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall(b'{"packages": [{"name": "app", "version_test": "", "version": ""}]}\n')
+        with s.makefile("rb") as f:
+            response = json.loads(f.readline())
+
+    assert [p["Package"] for p in response["closure"]] == ["app", "b"]
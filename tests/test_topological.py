@@ -0,0 +1,14 @@
+def test_stanza_index_follows_repo_pins(debdeps, debtopo):
+    # backports is pinned to 100, below the release's 500
+    config = [{"repo_url": "http://mirror", "distro": "b", "suites": ["release", "backports"],
+               "components": ["main"], "archs": ["amd64"]}]
+    release, backports = [url for *_, url in debdeps.repo_targets(config)]
+    contents = {
+        release: {"index": [{"Package": "app", "Version": "1", "Architecture": "amd64"}]},
+        backports: {"index": [{"Package": "app", "Version": "2", "Architecture": "amd64"}]},
+    }
+
+    index = debtopo.StanzaIndex(contents, debdeps.native_arch(config), debdeps.repo_pins(config))
+
+    assert [p.version for p in index.lookup(debdeps.Dependency("app", "", ""))] == ["1", "2"]
+    assert index.stanza(index.lookup(debdeps.Dependency("app", "", ""))[0])["Version"] == "1"
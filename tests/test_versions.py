@@ -0,0 +1,46 @@
+import pytest
+
+# (a, b, sign of a compared to b), as dpkg --compare-versions orders them
+CASES = [
+    ("1.0", "1.0", 0),
+    ("1.0", "1.1", -1),
+    ("1.0~rc1", "1.0", -1),
+    ("1.0~~", "1.0~", -1),
+    ("1.0", "1.0-1", -1),
+    ("1.0-1", "1.0-1.1", -1),
+    ("1.0+b1", "1.0", 1),
+    ("7.6p2-4", "7.6-0", 1),
+    ("1.0a", "1.0+", -1),
+    ("1:0.1", "2.0", 1),
+    ("0:1.0", "1.0", 0),
+    ("1.2-3-4", "1.2-3-5", -1),
+    # The epoch ends at the first colon, later ones belong to the upstream version
+    ("1:2:3-4", "1:2:3-4", 0),
+    ("1:2:3-4", "1:2:4-4", -1),
+    ("2:1:0", "1:9:9", 1),
+    ("1:2:3", "1:2.3", 1),
+    ("0:1:2", "1:2", -1),
+    ("1:1:1-1", "1:1.1-1", 1),
+]
+
+
+def sign(n):
+    return (n > 0) - (n < 0)
+
+
+@pytest.mark.parametrize("a, b, expected", CASES)
+def test_debian_version_compare(debdeps, a, b, expected):
+    assert sign(debdeps.debian_version_compare(a, b)) == expected
+    assert sign(debdeps.debian_version_compare(b, a)) == -expected
+
+
+@pytest.mark.parametrize("a, b, expected", CASES)
+def test_version_compare(debdeps, a, b, expected):
+    assert sign(debdeps.version_compare(a, b)) == expected
+
+
+def test_satisfying_with_colons_in_upstream(debdeps):
+    index = debdeps.build_index([debdeps.PackageRecord("foo", v) for v in ("1:2:3-1", "1:2:10-1", "1:2.5-1")])
+    dep = debdeps.Dependency("foo", ">=", "1:2:4")
+
+    assert [p.version for p in debdeps.satisfying(index["foo"], dep)] == ["1:2:10-1"]